@@ -0,0 +1,203 @@
+import argparse
+import asyncio
+import gzip
+import logging
+import os
+import re
+import shutil
+import sqlite3
+import time
+from time import perf_counter
+import clock
+import tenants
+
+logger = logging.getLogger(__name__)
+
+# Online snapshots of the tenant databases, taken with SQLite's incremental
+# backup API while the bot keeps writing. The copy runs in a worker thread a
+# few pages per step and pauses between steps, so a writer such as
+# save_ride_request is held up by one step at most. Snapshots are gzipped into
+# BACKUP_DIR, the newest BACKUP_KEEP per tenant are kept.
+#
+# Snapshots are off unless BACKUP_DIR is set. It should survive restarts and
+# redeploys, or there is nothing to restore from: a volume mounted from outside
+# the container, or a network share. A directory on the same filesystem as the
+# app, such as a dyno's ephemeral disk, gets a warning unless
+# BACKUP_DIR_PERSISTENT=1 says that disk is persistent.
+#
+# Usage: python backup.py snapshot
+#        python backup.py list
+#        python backup.py restore [--tenant ID] [--snapshot FILE] [--force]
+BACKUP_DIR = os.getenv('BACKUP_DIR')
+BACKUP_DIR_PERSISTENT = os.getenv('BACKUP_DIR_PERSISTENT', '0') == '1'
+BACKUP_KEEP = int(os.getenv('BACKUP_KEEP', 24))
+BACKUP_INTERVAL_MINUTES = int(os.getenv('BACKUP_INTERVAL_MINUTES', 60))
+BACKUP_PAGES_PER_STEP = int(os.getenv('BACKUP_PAGES_PER_STEP', 16))
+BACKUP_STEP_PAUSE = float(os.getenv('BACKUP_STEP_PAUSE', 0.005))  # Seconds writers get between two steps
+
+# Metrics of the last snapshot per tenant id, also logged
+last_snapshot = {}
+
+def snapshots_enabled():
+    # Whether BACKUP_DIR is set. Snapshots never keep the bot from running, a
+    # BACKUP_DIR that may not survive a restart only gets a warning.
+    if not BACKUP_DIR:
+        logger.warning('BACKUP_DIR is not set, database snapshots are disabled.')
+        return False
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+    if not BACKUP_DIR_PERSISTENT and os.stat(BACKUP_DIR).st_dev == os.stat(os.getcwd()).st_dev:
+        logger.warning(
+            f'BACKUP_DIR {BACKUP_DIR} is on the same filesystem as the app, snapshots are lost on restart on '
+            'ephemeral hosts. Mount a persistent volume there, or set BACKUP_DIR_PERSISTENT=1 if this disk is persistent.'
+        )
+    return True
+
+def snapshot_path(tenant):
+    return os.path.join(BACKUP_DIR, f"{tenant.id}-{clock.now().strftime('%Y%m%d-%H%M%S')}.db.gz")
+
+def tenant_snapshots(tenant_id):
+    # Newest first, the timestamp in the name sorts chronologically
+    if not os.path.isdir(BACKUP_DIR):
+        return []
+    pattern = re.compile(rf'{re.escape(tenant_id)}-\d{{8}}-\d{{6}}\.db\.gz')
+    names = [name for name in os.listdir(BACKUP_DIR) if pattern.fullmatch(name)]
+    return [os.path.join(BACKUP_DIR, name) for name in sorted(names, reverse=True)]
+
+def copy_database(source, target_path, metrics):
+    # Runs in a worker thread. The source is the tenant's own connection, so
+    # the bot's writes during the copy are carried over instead of restarting it.
+    step_started = [perf_counter()]
+
+    def progress(status, remaining, total):
+        metrics['steps'] += 1
+        metrics['pages'] = total
+        metrics['longest_step'] = max(metrics['longest_step'], perf_counter() - step_started[0])
+        time.sleep(BACKUP_STEP_PAUSE)  # Let writers in
+        step_started[0] = perf_counter()
+
+    target = sqlite3.connect(target_path)
+    try:
+        source.backup(target, pages=BACKUP_PAGES_PER_STEP, progress=progress)
+    finally:
+        target.close()
+
+def compress(path, compressed_path):
+    with open(path, 'rb') as database, gzip.open(compressed_path + '.tmp', 'wb') as snapshot:
+        shutil.copyfileobj(database, snapshot)
+    os.replace(compressed_path + '.tmp', compressed_path)
+    os.remove(path)
+
+def rotate(tenant_id):
+    for path in tenant_snapshots(tenant_id)[BACKUP_KEEP:]:
+        os.remove(path)
+
+async def snapshot(tenant):
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+    path = snapshot_path(tenant)
+    copy_path = path[:-len('.gz')] + '.tmp'
+
+    # ride_manager.save_ride_request adds the bookings saved during the copy
+    # and how long the longest one took, waiting on the copy included
+    metrics = {'steps': 0, 'pages': 0, 'longest_step': 0.0, 'writes': 0, 'longest_write': 0.0}
+    started = perf_counter()
+    tenant.snapshot = metrics
+    try:
+        await asyncio.to_thread(copy_database, tenant.conn, copy_path, metrics)
+    finally:
+        tenant.snapshot = None
+    await asyncio.to_thread(compress, copy_path, path)
+    rotate(tenant.id)
+
+    metrics['duration'] = perf_counter() - started
+    metrics['size'] = os.path.getsize(path)
+    last_snapshot[tenant.id] = metrics
+    logger.info(
+        f"Snapshot {path}: duration_ms={metrics['duration'] * 1000:.1f} "
+        f"longest_step_ms={metrics['longest_step'] * 1000:.1f} steps={metrics['steps']} pages={metrics['pages']} "
+        f"writes={metrics['writes']} longest_write_ms={metrics['longest_write'] * 1000:.1f} bytes={metrics['size']}"
+    )
+    return path
+
+# Scheduled by shuttle_bot every BACKUP_INTERVAL_MINUTES
+async def snapshot_all():
+    for tenant in tenants.tenants:
+        try:
+            await snapshot(tenant)
+        except Exception as e:
+            logger.error(f"Error taking snapshot of {tenant.id}: {e}")
+
+def restore(tenant, snapshot_file=None, force=False):
+    # Restores the newest snapshot, or snapshot_file, over the tenant's database.
+    # Without force an existing database is left alone, so this is safe to run
+    # at every startup. The bot must not be running.
+    if os.path.exists(tenant.database) and not force:
+        print(f"{tenant.id}: {tenant.database} exists, not restoring (use --force to overwrite).")
+        return False
+
+    if snapshot_file is None:
+        snapshots = tenant_snapshots(tenant.id)
+        if not snapshots:
+            print(f"{tenant.id}: no snapshot to restore.")
+            return False
+        snapshot_file = snapshots[0]
+
+    restore_path = tenant.database + '.restore'
+    with gzip.open(snapshot_file, 'rb') as snapshot, open(restore_path, 'wb') as database:
+        shutil.copyfileobj(snapshot, database)
+
+    # Refuse a damaged snapshot before it replaces anything
+    conn = sqlite3.connect(restore_path)
+    try:
+        result = conn.execute('PRAGMA integrity_check').fetchone()[0]
+    finally:
+        conn.close()
+    if result != 'ok':
+        os.remove(restore_path)
+        print(f"{tenant.id}: {snapshot_file} failed the integrity check: {result}")
+        return False
+
+    for suffix in ['-journal', '-wal', '-shm']:
+        if os.path.exists(tenant.database + suffix):
+            os.remove(tenant.database + suffix)
+    os.replace(restore_path, tenant.database)
+    print(f"{tenant.id}: restored {tenant.database} from {snapshot_file}.")
+    return True
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Snapshot and restore the tenant databases.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('snapshot', help='take a snapshot of every tenant database now')
+    subparsers.add_parser('list', help='list the snapshots of every tenant')
+    restore_parser = subparsers.add_parser('restore', help='restore tenant databases from their newest snapshot')
+    restore_parser.add_argument('--tenant', help='only restore this tenant')
+    restore_parser.add_argument('--snapshot', help='restore this snapshot file instead of the newest, needs --tenant')
+    restore_parser.add_argument('--force', action='store_true', help='overwrite an existing database')
+    args = parser.parse_args()
+
+    if not snapshots_enabled():
+        if args.command == 'snapshot':
+            parser.error('set BACKUP_DIR to take snapshots')
+        print('BACKUP_DIR is not set, there are no snapshots.')
+        return
+
+    if args.command == 'snapshot':
+        # Imported here, restore must run before ride_manager opens the databases
+        import ride_manager
+        asyncio.run(snapshot_all())
+    elif args.command == 'list':
+        for tenant in tenants.tenants:
+            print(f"{tenant.id}:")
+            for path in tenant_snapshots(tenant.id):
+                print(f"  {path} ({os.path.getsize(path)} bytes)")
+    else:
+        if args.snapshot and not args.tenant:
+            parser.error('--snapshot needs --tenant')
+        selected = [tenant for tenant in tenants.tenants if args.tenant in [None, tenant.id]]
+        if not selected:
+            parser.error(f'unknown tenant {args.tenant}')
+        for tenant in selected:
+            restore(tenant, args.snapshot, args.force)
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    main()
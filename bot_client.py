@@ -0,0 +1,50 @@
+import os
+import httpx
+from telegram.ext import ExtBot
+from telegram.request import HTTPXRequest
+
+# The one Bot shared by the Application, the handlers and the scheduled
+# notification jobs, so they all reuse the same HTTP connection pool.
+bot_token = os.getenv('BOT_TOKEN')
+if not bot_token:
+    raise RuntimeError('BOT_TOKEN environment variable is not set.')
+
+# Connection pool settings, tunable from the environment
+BOT_POOL_SIZE = int(os.getenv('BOT_POOL_SIZE', 8))
+BOT_KEEPALIVE_EXPIRY = float(os.getenv('BOT_KEEPALIVE_EXPIRY', 60))  # Seconds an idle connection is kept open
+BOT_CONNECT_TIMEOUT = float(os.getenv('BOT_CONNECT_TIMEOUT', 5))
+BOT_READ_TIMEOUT = float(os.getenv('BOT_READ_TIMEOUT', 5))
+BOT_WRITE_TIMEOUT = float(os.getenv('BOT_WRITE_TIMEOUT', 5))
+BOT_POOL_TIMEOUT = float(os.getenv('BOT_POOL_TIMEOUT', 5))
+# HTTP/2 needs python-telegram-bot[http2]
+BOT_HTTP2 = os.getenv('BOT_HTTP2', '0') == '1'
+
+class PooledRequest(HTTPXRequest):
+    # HTTPXRequest with a configurable keep-alive expiry for idle connections
+    def __init__(self, keepalive_expiry, **kwargs):
+        self._keepalive_expiry = keepalive_expiry
+        super().__init__(**kwargs)
+
+    # Overrides a private HTTPXRequest method, python-telegram-bot is pinned to
+    # 21.3 in requirements.txt for it. 21.6 and later take httpx_kwargs instead.
+    def _build_client(self) -> httpx.AsyncClient:
+        limits = self._client_kwargs['limits']
+        self._client_kwargs['limits'] = httpx.Limits(
+            max_connections=limits.max_connections,
+            max_keepalive_connections=limits.max_keepalive_connections,
+            keepalive_expiry=self._keepalive_expiry,
+        )
+        return super()._build_client()
+
+def create_request():
+    return PooledRequest(
+        keepalive_expiry=BOT_KEEPALIVE_EXPIRY,
+        connection_pool_size=BOT_POOL_SIZE,
+        connect_timeout=BOT_CONNECT_TIMEOUT,
+        read_timeout=BOT_READ_TIMEOUT,
+        write_timeout=BOT_WRITE_TIMEOUT,
+        pool_timeout=BOT_POOL_TIMEOUT,
+        http_version='2' if BOT_HTTP2 else '1.1',
+    )
+
+bot = ExtBot(bot_token, request=create_request())
@@ -0,0 +1,55 @@
+import asyncio
+import heapq
+import time
+from datetime import datetime, timedelta
+from itertools import count
+
+# Handlers and jobs read the current time through now() instead of
+# datetime.now(), so the replay tool can run them on a virtual clock.
+virtual_now = None
+
+# Coroutines waiting in sleep() on the virtual clock, a heap of
+# (wake up time, sequence, future). set_virtual_time wakes them.
+sleepers = []
+sleeper_sequence = count()
+
+def now(tz=None):
+    if virtual_now is None:
+        return datetime.now(tz)
+    if tz is None:
+        # Naive local time, like datetime.now()
+        return virtual_now.astimezone().replace(tzinfo=None)
+    return virtual_now.astimezone(tz)
+
+def monotonic():
+    # Seconds for measuring intervals, like time.monotonic()
+    if virtual_now is None:
+        return time.monotonic()
+    return virtual_now.timestamp()
+
+async def sleep(seconds):
+    # asyncio.sleep() that follows the virtual clock while one is set
+    if virtual_now is None:
+        await asyncio.sleep(seconds)
+        return
+    future = asyncio.get_running_loop().create_future()
+    heapq.heappush(sleepers, (virtual_now + timedelta(seconds=max(seconds, 0)), next(sleeper_sequence), future))
+    await future
+
+def next_wakeup():
+    # When the earliest sleeper on the virtual clock is due, or None
+    while sleepers and sleepers[0][2].done():
+        heapq.heappop(sleepers)  # Cancelled
+    if not sleepers:
+        return None
+    return sleepers[0][0]
+
+def set_virtual_time(moment):
+    # moment is a timezone aware datetime, or None to go back to the real clock
+    global virtual_now
+    virtual_now = moment
+
+    while sleepers and (moment is None or sleepers[0][0] <= moment):
+        _, _, future = heapq.heappop(sleepers)
+        if not future.done():
+            future.set_result(None)
@@ -0,0 +1,146 @@
+import asyncio
+import logging
+import os
+from telegram.error import BadRequest, Forbidden, RetryAfter
+import bot_client
+import clock
+import ride_manager as rm
+import tenants
+
+logger = logging.getLogger(__name__)
+
+# Sends personalized direct messages to every rider of a departure slot.
+# Sends run concurrently, bounded by FANOUT_CONCURRENCY, and are paced to stay
+# under Telegram's flood limits: FANOUT_GLOBAL_RATE messages per second in
+# total and one message per FANOUT_CHAT_INTERVAL seconds to the same chat.
+# The fan-out shares the bot's connection pool with the handlers, so by default
+# it leaves two connections free for them.
+FANOUT_CONCURRENCY = int(os.getenv('FANOUT_CONCURRENCY', max(1, bot_client.BOT_POOL_SIZE - 2)))
+FANOUT_GLOBAL_RATE = float(os.getenv('FANOUT_GLOBAL_RATE', 25))
+FANOUT_CHAT_INTERVAL = float(os.getenv('FANOUT_CHAT_INTERVAL', 1))
+# Seconds between two progress edits in the driver's chat
+FANOUT_PROGRESS_INTERVAL = float(os.getenv('FANOUT_PROGRESS_INTERVAL', 2))
+# Attempts per message when Telegram asks to retry later
+FANOUT_ATTEMPTS = 3
+
+class RateLimiter:
+    # Spaces out calls to one per interval seconds, in the order they arrive
+    def __init__(self, interval):
+        self.interval = interval
+        self.next_slot = 0
+
+    async def wait(self):
+        now = clock.monotonic()
+        slot = max(now, self.next_slot)
+        self.next_slot = slot + self.interval
+        if slot > now:
+            await clock.sleep(slot - now)
+
+global_limiter = RateLimiter(1 / FANOUT_GLOBAL_RATE)
+chat_limiters = {}  # chat id -> RateLimiter, shared by overlapping fan-outs
+
+class FanOut:
+    # Delivery counts of one fan-out
+    def __init__(self, title, total):
+        self.title = title
+        self.total = total
+        self.delivered = 0
+        self.blocked = 0
+        self.failed = 0
+        self.skipped = 0
+        self.started = clock.monotonic()
+
+    def progress_text(self, finished=False):
+        message = f"📨 {self.title}: {self.delivered}/{self.total} delivered"
+        if self.skipped:
+            message += f", {self.skipped} skipped (blocked the bot)"
+        if self.blocked:
+            message += f", {self.blocked} newly blocked"
+        if self.failed:
+            message += f", {self.failed} failed"
+        if finished:
+            message += f". Done in {clock.monotonic() - self.started:.1f}s."
+        return message
+
+async def send_direct_message(user_id, text):
+    # Returns 'delivered', 'blocked' or 'failed'
+    chat_limiter = chat_limiters.setdefault(user_id, RateLimiter(FANOUT_CHAT_INTERVAL))
+    for attempt in range(FANOUT_ATTEMPTS):
+        await chat_limiter.wait()
+        await global_limiter.wait()
+        try:
+            await bot_client.bot.send_message(user_id, text)
+            return 'delivered'
+        except Forbidden:
+            return 'blocked'
+        except RetryAfter as e:
+            # Telegram's flood wait applies to the whole bot, hold back every sender
+            logger.warning(f"Flood limit hit sending to {user_id}, retrying in {e.retry_after}s")
+            global_limiter.next_slot = max(global_limiter.next_slot, clock.monotonic() + e.retry_after)
+        except BadRequest as e:
+            logger.error(f"Error sending direct message to {user_id}: {e}")
+            return 'failed'
+        except Exception as e:
+            logger.error(f"Error sending direct message to {user_id}: {e}")
+    return 'failed'
+
+async def edit_progress(text, chat_id, message_id):
+    try:
+        await bot_client.bot.edit_message_text(text, chat_id=chat_id, message_id=message_id)
+    except Exception as e:
+        logger.error(f"Error reporting fan-out progress: {e}")
+
+# Edits the progress message until cancelled, fan_out writes the final one
+async def report_progress(delivery, chat_id, message_id):
+    last_text = delivery.progress_text()
+    while True:
+        await clock.sleep(FANOUT_PROGRESS_INTERVAL)
+        text = delivery.progress_text()
+        if text != last_text:
+            await edit_progress(text, chat_id, message_id)
+            last_text = text
+
+# Send each (user_id, text) message of a tenant's riders and report progress
+# in report_chat_id. Rides booked on behalf of someone have no chat to send
+# to, callers leave them out.
+async def fan_out(tenant, title, messages, report_chat_id):
+    with tenants.use(tenant):
+        blocked_users = rm.get_blocked_users()
+
+    pending = [(int(user_id), text) for user_id, text in messages if str(user_id) not in blocked_users]
+    delivery = FanOut(title, len(messages))
+    delivery.skipped = len(messages) - len(pending)
+
+    report = await bot_client.bot.send_message(report_chat_id, delivery.progress_text())
+    reporter = asyncio.create_task(report_progress(delivery, report_chat_id, report.message_id))
+
+    semaphore = asyncio.Semaphore(FANOUT_CONCURRENCY)
+    newly_blocked = []
+
+    async def deliver(user_id, text):
+        async with semaphore:
+            result = await send_direct_message(user_id, text)
+        if result == 'delivered':
+            delivery.delivered += 1
+        elif result == 'blocked':
+            delivery.blocked += 1
+            newly_blocked.append(user_id)
+        else:
+            delivery.failed += 1
+
+    try:
+        await asyncio.gather(*(deliver(user_id, text) for user_id, text in pending))
+    finally:
+        if newly_blocked:
+            with tenants.use(tenant):
+                rm.mark_users_blocked(newly_blocked)
+        reporter.cancel()
+    await edit_progress(delivery.progress_text(True), report_chat_id, report.message_id)
+
+    # Forget per-chat pacing that no longer delays anything
+    now = clock.monotonic()
+    for user_id in [user_id for user_id, limiter in chat_limiters.items() if limiter.next_slot < now]:
+        del chat_limiters[user_id]
+
+    logger.info(delivery.progress_text(True))
+    return delivery
@@ -0,0 +1,149 @@
+import logging
+import math
+import os
+from datetime import timedelta
+from telegram.error import BadRequest
+from telegram.ext import CallbackContext
+import bot_client
+import clock
+import ride_manager as rm
+import stops
+import tenants
+
+logger = logging.getLogger(__name__)
+
+# Drivers share their Telegram live location in the drivers chat. Every
+# position update recomputes the ETA to each pending pickup stop of the slot
+# the bus is serving (ride_manager.served_slot), and one pinned status message
+# per slot in the students chat is edited with them. Edits are coalesced: at most one per ETA_EDIT_INTERVAL
+# seconds, and only once an ETA moved by ETA_CHANGE_THRESHOLD minutes.
+ETA_EDIT_INTERVAL = float(os.getenv('ETA_EDIT_INTERVAL', 30))
+ETA_CHANGE_THRESHOLD = float(os.getenv('ETA_CHANGE_THRESHOLD', 2))
+# Average bus speed, and how much longer the road is than the straight line
+BUS_SPEED_KMH = float(os.getenv('BUS_SPEED_KMH', 20))
+ROAD_FACTOR = 1.3
+
+class SlotStatus:
+    # The pinned status message of one departure slot
+    def __init__(self, slot, message_id, etas):
+        self.slot = slot
+        self.message_id = message_id
+        self.published = etas   # ETAs shown in the message
+        self.latest = etas      # ETAs from the most recent position
+        self.riders = {}
+        self.last_edit = clock.now()
+        self.edit_job = None
+
+def distance_km(lat1, lon1, lat2, lon2):
+    # Haversine distance
+    lat1, lon1, lat2, lon2 = map(math.radians, [lat1, lon1, lat2, lon2])
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 6371 * 2 * math.asin(math.sqrt(a))
+
+def stop_etas(latitude, longitude, stop_ids):
+    # Minutes to each stop when the bus visits the nearest remaining stop next.
+    # Stops without coordinates get no ETA.
+    etas = {}
+    remaining = []
+    for stop_id in stop_ids:
+        stop = stops.stops_by_id.get(stop_id)
+        if stop is None or stop.get('lat') is None or stop.get('lon') is None:
+            etas[stop_id] = None
+        else:
+            remaining.append((stop_id, stop['lat'], stop['lon']))
+
+    minutes = 0
+    while remaining:
+        stop_id, lat, lon = min(remaining, key=lambda stop: distance_km(latitude, longitude, stop[1], stop[2]))
+        minutes += distance_km(latitude, longitude, lat, lon) * ROAD_FACTOR / BUS_SPEED_KMH * 60
+        etas[stop_id] = round(minutes)
+        latitude, longitude = lat, lon
+        remaining.remove((stop_id, lat, lon))
+    return etas
+
+def etas_changed(published, latest):
+    if published.keys() != latest.keys():
+        return True
+    for stop_id, eta in latest.items():
+        previous = published[stop_id]
+        if (eta is None) != (previous is None):
+            return True
+        if eta is not None and abs(eta - previous) >= ETA_CHANGE_THRESHOLD:
+            return True
+    return False
+
+def status_text(status):
+    message = f"🚌 The bus is en route for the {status.slot} departure.\n\n"
+    if not status.latest:
+        message += "No pending pickups."
+    for stop_id, eta in sorted(status.latest.items(), key=lambda item: (item[1] is None, item[1] or 0)):
+        riders = status.riders.get(stop_id, 0)
+        arrival = f"~{eta} min" if eta is not None else "ETA unavailable"
+        message += f"- {stops.stop_name(stop_id)}: {arrival} ({riders} {'rider' if riders == 1 else 'riders'})\n"
+    return message + f"\nUpdated {clock.now().strftime('%H:%M')}"
+
+async def start_status(tenant, slot, etas, riders):
+    # Replace the previous slot's pinned message with a new one for this slot
+    previous = tenant.live_status
+    if previous is not None:
+        if previous.edit_job is not None:
+            previous.edit_job.schedule_removal()
+        try:
+            await bot_client.bot.unpin_chat_message(tenant.students_chat_id, previous.message_id)
+        except Exception as e:
+            logger.error(f"Error unpinning status message of {tenant.id}: {e}")
+
+    status = SlotStatus(slot, None, etas)
+    status.riders = riders
+    message = await bot_client.bot.send_message(tenant.students_chat_id, status_text(status))
+    status.message_id = message.message_id
+    tenant.live_status = status
+    try:
+        await bot_client.bot.pin_chat_message(tenant.students_chat_id, message.message_id, disable_notification=True)
+    except Exception as e:
+        logger.error(f"Error pinning status message of {tenant.id}: {e}")
+
+async def publish(tenant, status):
+    status.edit_job = None
+    if tenant.live_status is not status:
+        return  # The slot has moved on
+    try:
+        await bot_client.bot.edit_message_text(status_text(status), chat_id=tenant.students_chat_id, message_id=status.message_id)
+    except BadRequest as e:
+        if 'not modified' not in str(e):
+            raise
+    status.published = status.latest
+    status.last_edit = clock.now()
+
+async def publish_job(context: CallbackContext):
+    tenant, status = context.job.data
+    await publish(tenant, status)
+
+# Called for every live location update of the current tenant's driver
+async def update_location(latitude, longitude, job_queue):
+    tenant = tenants.current()
+    slot = rm.served_slot()
+    if slot == 'unscheduled':
+        return
+
+    rides = rm.get_slot_pending_rides(slot)
+    riders = {}
+    for ride in rides:
+        riders[ride[2]] = riders.get(ride[2], 0) + 1
+    etas = stop_etas(latitude, longitude, riders)
+
+    status = tenant.live_status
+    if status is None or status.slot != slot:
+        await start_status(tenant, slot, etas, riders)
+        return
+
+    status.latest = etas
+    status.riders = riders
+    if status.edit_job is not None or not etas_changed(status.published, etas):
+        return  # An edit is already due, it picks up the latest ETAs
+
+    due = status.last_edit + timedelta(seconds=ETA_EDIT_INTERVAL)
+    if due <= clock.now():
+        await publish(tenant, status)
+    else:
+        status.edit_job = job_queue.run_once(publish_job, when=due.astimezone(), data=(tenant, status), name=f'publish_eta_{tenant.id}')
@@ -1,12 +1,9 @@
+import logging
 from telegram.ext import CallbackContext
-from telegram import Bot
-import os
-# Initialize your bot with the token from environment variable
-bot_token = os.getenv('BOT_TOKEN')
-if not bot_token:
-    raise RuntimeError('BOT_TOKEN environment variable is not set.')
+import bot_client
+import tenants
 
-bot = Bot(bot_token)
+logger = logging.getLogger(__name__)
 
 # Messages for notifications
 START_WORKDAY_MESSAGE_DRIVERS = "🚗 Work day: Notification system started! Get ready for a productive day ahead. 🌟"
@@ -15,17 +12,30 @@ END_WORKDAY_MESSAGE_DRIVERS = "🌙 Job ended for today. Thank you for your hard
 START_WORKDAY_MESSAGE_STUDENTS = "🚌 Shuttle service is now available! You can start requesting rides. 🌟"
 END_WORKDAY_MESSAGE_STUDENTS = "🚌 Shuttle service has ended for today. See you again tomorrow! 👋"
 
-drivers_group_chat_id = -XXXXXXXXXX
-pwd_group_chat_id = -XXXXXXXXXX
+# One tenant's chat failing, e.g. the bot was removed from it, must not keep
+# the message from the other tenants
+async def notify_drivers_chats(message) -> None:
+    for tenant in tenants.tenants:
+        try:
+            await bot_client.bot.send_message(tenant.drivers_chat_id, message)
+        except Exception as e:
+            logger.error(f"Error notifying the drivers chat of {tenant.id}: {e}")
+
+async def notify_students_chats(message) -> None:
+    for tenant in tenants.tenants:
+        try:
+            await bot_client.bot.send_message(tenant.students_chat_id, message)
+        except Exception as e:
+            logger.error(f"Error notifying the students chat of {tenant.id}: {e}")
 
 async def notify_workday_start_drivers() -> None:
-    await bot.send_message(drivers_group_chat_id, START_WORKDAY_MESSAGE_DRIVERS)
+    await notify_drivers_chats(START_WORKDAY_MESSAGE_DRIVERS)
 
 async def notify_workday_end_drivers() -> None:
-    await bot.send_message(drivers_group_chat_id, END_WORKDAY_MESSAGE_DRIVERS)
+    await notify_drivers_chats(END_WORKDAY_MESSAGE_DRIVERS)
 
 async def notify_workday_start_students() -> None:
-    await bot.send_message(pwd_group_chat_id, START_WORKDAY_MESSAGE_STUDENTS)
+    await notify_students_chats(START_WORKDAY_MESSAGE_STUDENTS)
 
 async def notify_workday_end_students() -> None:
-    await bot.send_message(pwd_group_chat_id, END_WORKDAY_MESSAGE_STUDENTS)
+    await notify_students_chats(END_WORKDAY_MESSAGE_STUDENTS)
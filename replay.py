@@ -0,0 +1,274 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from itertools import count
+from time import perf_counter
+from apscheduler.jobstores.base import JobLookupError
+from apscheduler.triggers.interval import IntervalTrigger
+from telegram import Update
+from telegram.ext import ExtBot
+from telegram.request import BaseRequest
+import clock
+
+# Replays updates captured by update_recorder through the real handlers
+# against scratch tenant databases, on a virtual clock. Scheduler and job_queue jobs
+# fire on virtual time, and Bot API calls are answered locally.
+#
+# Usage: python replay.py updates.jsonl [updates.jsonl.2026-10-19 ...] --speed 1000
+
+logger = logging.getLogger('replay')
+
+# Virtual time allowed after the last update for background work to finish
+DRAIN_PERIOD = timedelta(minutes=5)
+
+class ReplayRequest(BaseRequest):
+    # Answers every Bot API call locally so a replay never reaches Telegram
+    def __init__(self):
+        self.calls = defaultdict(int)
+        self.message_ids = count(1)
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        endpoint = url.rsplit('/', 1)[-1]
+        self.calls[endpoint] += 1
+        parameters = request_data.parameters if request_data else {}
+        result = self.fake_result(endpoint, parameters)
+        return 200, json.dumps({'ok': True, 'result': result}).encode()
+
+    def fake_result(self, endpoint, parameters):
+        chat_id = int(parameters.get('chat_id', 0) or 0)
+        chat = {'id': chat_id, 'type': 'private' if chat_id > 0 else 'group', 'first_name': 'User', 'title': 'Group'}
+
+        if endpoint == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'Shuttle Bot', 'username': 'shuttle_bot'}
+        if endpoint == 'getChat':
+            return dict(chat, accent_color_id=0, max_reaction_count=11)
+        if endpoint in ['sendMessage', 'editMessageText']:
+            return {
+                'message_id': parameters.get('message_id') or next(self.message_ids),
+                'date': int(clock.now(timezone.utc).timestamp()),
+                'chat': chat,
+                'text': parameters.get('text', ''),
+            }
+        return True
+
+class VirtualScheduler:
+    # Fires the jobs of stopped APScheduler schedulers on the virtual clock
+    def __init__(self, schedulers):
+        self.schedulers = schedulers
+        self.next_run = {}
+
+    def next_due(self):
+        now = clock.now(timezone.utc)
+        earliest = None
+        for scheduler in self.schedulers:
+            for job in scheduler.get_jobs():
+                if getattr(job, 'next_run_time', now) is None:
+                    self.next_run.pop(job.id, None)  # Paused
+                    continue
+                if job.id not in self.next_run:
+                    # Interval jobs start when they are registered, which is now in virtual time
+                    if isinstance(job.trigger, IntervalTrigger):
+                        self.next_run[job.id] = now
+                    else:
+                        self.next_run[job.id] = job.trigger.get_next_fire_time(None, now)
+                fire_time = self.next_run[job.id]
+                if fire_time is not None and (earliest is None or fire_time < earliest[0]):
+                    earliest = (fire_time, job)
+        return earliest
+
+    async def run(self, fire_time, job):
+        next_fire_time = job.trigger.get_next_fire_time(fire_time, fire_time)
+        self.next_run[job.id] = next_fire_time
+        if next_fire_time is None:
+            try:
+                job.remove()
+            except JobLookupError:
+                pass
+
+        started = perf_counter()
+        try:
+            result = job.func(*job.args, **job.kwargs)
+            if asyncio.iscoroutine(result):
+                await result
+        except Exception as e:
+            logger.error(f'Job {job.name} failed: {e}')
+        return perf_counter() - started
+
+def load_updates(paths):
+    entries = []
+    for path in paths:
+        with open(path, encoding='utf-8') as log:
+            for line in log:
+                if line.strip():
+                    entry = json.loads(line)
+                    entries.append((datetime.fromisoformat(entry['received_at']), entry['update']))
+    entries.sort(key=lambda entry: entry[0])
+    return entries
+
+def handler_name(application, update):
+    for group in sorted(application.handlers):
+        if group < 0:
+            continue  # The recorder
+        for handler in application.handlers[group]:
+            check = handler.check_update(update)
+            if check is not None and check is not False:
+                return handler.callback.__name__
+    return 'unhandled'
+
+def database_stats(connections):
+    # Size and row counts summed over the tenant databases
+    size = 0
+    rows = defaultdict(int)
+    for conn in connections:
+        page_count = conn.execute('PRAGMA page_count').fetchone()[0]
+        page_size = conn.execute('PRAGMA page_size').fetchone()[0]
+        size += page_count * page_size
+        tables = [row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'")]
+        for table in tables:
+            rows[table] += conn.execute(f'SELECT COUNT(*) FROM "{table}"').fetchone()[0]
+    return size, rows
+
+# Turns of the event loop given to coroutines woken on the virtual clock
+# before time moves on, enough for a send and its bookkeeping
+SETTLE_ROUNDS = 20
+
+async def settle():
+    for _ in range(SETTLE_ROUNDS):
+        await asyncio.sleep(0)
+
+async def step(current, target, speed):
+    if speed and target > current:
+        await asyncio.sleep((target - current).total_seconds() / speed)
+    clock.set_virtual_time(max(current, target))
+    await settle()
+    return max(current, target)
+
+async def advance(current, target, speed):
+    # Wake the coroutines sleeping on the virtual clock in order on the way
+    wakeup = clock.next_wakeup()
+    while wakeup is not None and wakeup <= target:
+        current = await step(current, wakeup, speed)
+        wakeup = clock.next_wakeup()
+    return await step(current, target, speed)
+
+def report(latencies, request, db_before, db_after, span, elapsed):
+    print(f'Replayed {span} of traffic in {elapsed:.2f}s')
+    print()
+    print(f"{'Handler / job':<32}{'Count':>8}{'Mean ms':>10}{'p95 ms':>10}{'Max ms':>10}")
+    for name, samples in sorted(latencies.items()):
+        samples = sorted(samples)
+        mean = sum(samples) / len(samples) * 1000
+        p95 = samples[min(len(samples) - 1, int(len(samples) * 0.95))] * 1000
+        print(f'{name:<32}{len(samples):>8}{mean:>10.2f}{p95:>10.2f}{samples[-1] * 1000:>10.2f}')
+    print()
+
+    size_before, rows_before = db_before
+    size_after, rows_after = db_after
+    print(f'Database size: {size_before} -> {size_after} bytes ({size_after - size_before:+d})')
+    for table, rows in rows_after.items():
+        print(f'  {table}: {rows_before.get(table, 0)} -> {rows} rows')
+    print()
+    print('Bot API calls: ' + ', '.join(f'{endpoint} {calls}' for endpoint, calls in sorted(request.calls.items())))
+
+async def replay(paths, speed):
+    entries = load_updates(paths)
+    if not entries:
+        print('No updates to replay.')
+        return
+
+    clock.set_virtual_time(entries[0][0])
+
+    # Imported here, after RIDES_DB_DIR points at the scratch directory
+    import tenants
+    for tenant in tenants.tenants:
+        if os.path.dirname(os.path.abspath(tenant.database)) != os.environ['RIDES_DB_DIR']:
+            print(f'Database {tenant.database} of tenant {tenant.id} is outside the scratch directory, refusing to replay.')
+            return
+    import bot_client
+    import shuttle_bot
+
+    # Swap the shared bot for one that answers Bot API calls locally
+    request = ReplayRequest()
+    bot_client.bot = ExtBot(bot_client.bot_token, request=request)
+    application = shuttle_bot.build_application()
+    await application.initialize()
+    # Pauses driver notifications at night and on weekends, as in production
+    notifications_task = asyncio.create_task(shuttle_bot.start_tasks())
+    await settle()
+
+    jobs = VirtualScheduler([shuttle_bot.scheduler, application.job_queue.scheduler])
+    latencies = defaultdict(list)
+    db_before = database_stats(tenant.conn for tenant in tenants.tenants)
+    started = perf_counter()
+    current = entries[0][0]
+
+    for received_at, data in entries:
+        # Fire every job that falls due before this update arrives
+        due = jobs.next_due()
+        while due is not None and due[0] <= received_at:
+            current = await advance(current, due[0], speed)
+            latencies[f'job:{due[1].name}'].append(await jobs.run(*due))
+            due = jobs.next_due()
+
+        current = await advance(current, received_at, speed)
+        update = Update.de_json(data, application.bot)
+        name = handler_name(application, update)
+        update_started = perf_counter()
+        await application.process_update(update)
+        latencies[name].append(perf_counter() - update_started)
+        await settle()  # Let tasks the handler started run at this time
+
+    # Let background work such as direct message fan-outs finish
+    current = await advance(current, current + DRAIN_PERIOD, speed)
+
+    elapsed = perf_counter() - started
+    notifications_task.cancel()
+    db_after = database_stats(tenant.conn for tenant in tenants.tenants)
+    await application.shutdown()
+    clock.set_virtual_time(None)
+
+    report(latencies, request, db_before, db_after, entries[-1][0] - entries[0][0], elapsed)
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Replay recorded updates against scratch databases.')
+    parser.add_argument('logs', nargs='+', help='update logs written by update_recorder (UPDATE_LOG)')
+    parser.add_argument('--speed', type=float, default=1000,
+                        help='virtual seconds per real second, 1 to 1000, or 0 to replay as fast as possible (default: 1000)')
+    parser.add_argument('--db-dir', default='replay_db',
+                        help='scratch directory for the tenant databases, emptied for every run (default: replay_db)')
+    args = parser.parse_args()
+
+    if args.speed != 0 and not 1 <= args.speed <= 1000:
+        parser.error('--speed must be between 1 and 1000, or 0')
+    db_dir = os.path.abspath(args.db_dir)
+    if db_dir == os.path.abspath('.'):
+        parser.error('refusing to replay against the production databases')
+
+    os.makedirs(db_dir, exist_ok=True)
+    for name in os.listdir(db_dir):
+        if name.endswith('.db'):
+            os.remove(os.path.join(db_dir, name))
+    os.environ['RIDES_DB_DIR'] = db_dir
+    os.environ['BACKUP_DIR'] = os.path.join(db_dir, 'backups')
+    os.environ.pop('UPDATE_LOG', None)
+    os.environ.setdefault('BOT_TOKEN', '1:replay')
+
+    asyncio.run(replay(args.logs, args.speed))
+
+if __name__ == '__main__':
+    main()
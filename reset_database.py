@@ -2,9 +2,15 @@ import asyncio
 import sqlite3
 from datetime import datetime, time
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
+import tenants
 
 def reset_database():
-    conn = sqlite3.connect('rides.db')
+    # Every tenant has its own database
+    for tenant in tenants.tenants:
+        reset_tenant_database(tenant.database)
+
+def reset_tenant_database(database):
+    conn = sqlite3.connect(database)
     c = conn.cursor()
     
     # Drop existing tables if they exist
@@ -15,17 +21,19 @@ def reset_database():
         CREATE TABLE ride_requests (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             user_id TEXT NOT NULL,
-            location TEXT NOT NULL,
-            destination TEXT NOT NULL,
+            location_id INTEGER NOT NULL,
+            destination_id INTEGER NOT NULL,
             time TEXT NOT NULL,
             purpose TEXT NOT NULL,
-            status TEXT DEFAULT 'pending'
+            status TEXT DEFAULT 'pending',
+            booked_by TEXT
         )
     ''')
+    c.execute('CREATE INDEX ride_requests_location ON ride_requests (location_id, status)')
     
     conn.commit()
     conn.close()
-    print("Database reset successfully.")
+    print(f"Database {database} reset successfully.")
 
 async def reset_database_daily():
     scheduler = AsyncIOScheduler()
@@ -1,6 +1,12 @@
 import sqlite3
+import heapq
 from datetime import datetime, timedelta
 import logging
+from time import perf_counter
+from telegram.ext import CallbackContext
+import clock
+import stops
+import tenants
 
 # Enable logging
 logging.basicConfig(
@@ -9,46 +15,195 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Database setup
-conn = sqlite3.connect('rides.db', check_same_thread=False)
-c = conn.cursor()
+# Database setup, one SQLite file per tenant so their writes never contend
+# Columns of every table, also used to rebuild a table when it is migrated
+TABLE_COLUMNS = {
+    'ride_requests': '''
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id TEXT NOT NULL,
+        location_id INTEGER NOT NULL,
+        destination_id INTEGER NOT NULL,
+        time TEXT NOT NULL,
+        purpose TEXT NOT NULL,
+        status TEXT DEFAULT 'pending',
+        booked_by TEXT
+    ''',
+    'ride_stats': '''
+        date TEXT NOT NULL,
+        slot TEXT NOT NULL,
+        purpose TEXT NOT NULL,
+        location_id INTEGER NOT NULL,
+        destination_id INTEGER NOT NULL,
+        requested INTEGER NOT NULL DEFAULT 0,
+        completed INTEGER NOT NULL DEFAULT 0,
+        cancelled INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (date, slot, purpose, location_id, destination_id)
+    ''',
+    'recurring_rides': '''
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id TEXT NOT NULL,
+        days TEXT NOT NULL,
+        location_id INTEGER NOT NULL,
+        destination_id INTEGER NOT NULL,
+        time TEXT NOT NULL,
+        purpose TEXT NOT NULL,
+        skip_date TEXT
+    ''',
+    'blocked_users': '''
+        user_id TEXT PRIMARY KEY,
+        blocked_at TEXT NOT NULL
+    ''',
+}
 
-def save_ride_request(user_id, location, destination, time, purpose):
+def create_tables(c):
+    for table, columns in TABLE_COLUMNS.items():
+        c.execute(f'CREATE TABLE IF NOT EXISTS {table} ({columns})')
+
+    for table in ['ride_requests', 'recurring_rides', 'ride_stats']:
+        migrate_stop_columns(c, table)
+
+    # booked_by is the Telegram user who booked a ride with /ride_for, only they may cancel or complete it
+    ride_columns = [column[1] for column in c.execute('PRAGMA table_info(ride_requests)')]
+    if 'booked_by' not in ride_columns:
+        c.execute('ALTER TABLE ride_requests ADD COLUMN booked_by TEXT')
+
+    c.execute('CREATE INDEX IF NOT EXISTS ride_requests_location ON ride_requests (location_id, status)')
+
+def stored_stop_id(value):
+    # Stop id of a stored location, either a stop id already or a free-text name. None when unknown.
+    if value is None:
+        return None
+    if str(value).isdigit() and int(value) in stops.stops_by_id:
+        return int(value)
+    return stops.resolve(str(value))[0]
+
+# Tables from before the stop registry have free-text location and destination
+# columns, and tables migrated by renaming those columns kept their TEXT
+# affinity, so stop ids ended up stored as '1'. Both are rebuilt with INTEGER
+# stop ids. Rows whose places do not resolve to a stop are not guessed at: they
+# are moved, unchanged, to <table>_unresolved, out of the bot's way, and logged,
+# so they can be fixed by hand or brought back once stops.json has the stop.
+def migrate_stop_columns(c, table):
+    columns = {column[1]: column[2].upper() for column in c.execute(f'PRAGMA table_info({table})')}
+    if 'location' in columns:
+        location, destination = 'location', 'destination'
+    elif columns.get('location_id') != 'INTEGER':
+        location, destination = 'location_id', 'destination_id'
+    else:
+        return
+
+    conn = c.connection
+    conn.create_function('stored_stop_id', 1, stored_stop_id, deterministic=True)
+    if not conn.in_transaction:
+        c.execute('BEGIN')
+
+    migrated = f'{table}_migrated'
+    c.execute(f'DROP TABLE IF EXISTS {migrated}')
+    c.execute(f'CREATE TABLE {migrated} ({TABLE_COLUMNS[table]})')
+    resolved = f'stored_stop_id({location}) IS NOT NULL AND stored_stop_id({destination}) IS NOT NULL'
+    if table == 'ride_stats':
+        # Spellings of the same stop become one key, their counts add up
+        c.execute(f'''
+            INSERT INTO ride_stats_migrated (date, slot, purpose, location_id, destination_id, requested, completed, cancelled)
+            SELECT date, slot, purpose, stored_stop_id({location}), stored_stop_id({destination}),
+                   SUM(requested), SUM(completed), SUM(cancelled)
+            FROM ride_stats WHERE {resolved}
+            GROUP BY 1, 2, 3, 4, 5
+        ''')
+    else:
+        new_columns = [column[1] for column in c.execute(f'PRAGMA table_info({migrated})').fetchall()]
+        copied = ', '.join(column for column in new_columns if column in columns and column not in ['location_id', 'destination_id'])
+        c.execute(f'''
+            INSERT INTO {migrated} ({copied}, location_id, destination_id)
+            SELECT {copied}, stored_stop_id({location}), stored_stop_id({destination})
+            FROM {table} WHERE {resolved}
+        ''')
+        # Ids of rides set aside are never handed out again
+        last_id = c.execute(f'SELECT MAX(id) FROM {table}').fetchone()[0]
+        if last_id is not None:
+            c.execute('DELETE FROM sqlite_sequence WHERE name = ?', (migrated,))
+            c.execute('INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)', (migrated, last_id))
+    migrated_rows = c.execute(f'SELECT COUNT(*) FROM {migrated}').fetchone()[0]
+
+    c.execute(f'DELETE FROM {table} WHERE {resolved}')
+    unresolved = c.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+    indexes = c.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL", (table,)).fetchall()
+    for (index,) in indexes:
+        c.execute(f'DROP INDEX {index}')
+    if unresolved:
+        c.execute(f'ALTER TABLE {table} RENAME TO {table}_unresolved')
+        logger.warning(f'Moved {unresolved} {table} rows naming places that are not stops to {table}_unresolved')
+    else:
+        c.execute(f'DROP TABLE {table}')
+    c.execute(f'ALTER TABLE {migrated} RENAME TO {table}')
+    conn.commit()
+    logger.info(f'Migrated {table} to stop ids: {migrated_rows} rows')
+
+for tenant in tenants.tenants:
+    tenant.conn = sqlite3.connect(tenant.database, check_same_thread=False)
+    tenant.c = tenant.conn.cursor()
+    create_tables(tenant.c)
+    tenant.conn.commit()
+
+def db():
+    # Connection and cursor of the tenant the running handler or job works on
+    tenant = tenants.current()
+    if tenant is None:
+        raise RuntimeError('No tenant selected for this chat.')
+    return tenant.conn, tenant.c
+
+# location_id and destination_id are stop ids from the stop registry (stops.py)
+# booked_by is the Telegram user id of whoever booked a ride on behalf of user_id
+def save_ride_request(user_id, location_id, destination_id, time, purpose, booked_by=None):
+    conn, c = db()
     if not user_can_book_ride(user_id, time):
         return None
+    started = perf_counter()
     c.execute('''
-        INSERT INTO ride_requests (user_id, location, destination, time, purpose)
-        VALUES (?, ?, ?, ?, ?)
-    ''', (user_id, location, destination, time, purpose))
+        INSERT INTO ride_requests (user_id, location_id, destination_id, time, purpose, booked_by)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', (user_id, location_id, destination_id, time, purpose, None if booked_by is None else str(booked_by)))
+    ride_id = c.lastrowid
+    record_ride_stats([(ride_id, user_id, location_id, destination_id, time, purpose, 'pending')], 'requested')
+    # A rider who books again is reached by direct messages again
+    c.execute('DELETE FROM blocked_users WHERE user_id = ?', (str(user_id),))
     conn.commit()
-    logger.info(f'Saved ride request: user_id={user_id}, location={location}, destination={destination}, time={time}, purpose={purpose}')
-    return c.lastrowid
+    # Bookings saved while a snapshot copies the database are reported with it
+    snapshot = tenants.current().snapshot
+    if snapshot is not None:
+        snapshot['writes'] += 1
+        snapshot['longest_write'] = max(snapshot['longest_write'], perf_counter() - started)
+    logger.info(f'Saved ride request: user_id={user_id}, location_id={location_id}, destination_id={destination_id}, time={time}, purpose={purpose}')
+    schedule_auto_complete(ride_id, time)
+    return ride_id
 
 def get_ride_status(ride_id):
+    conn, c = db()
     c.execute('SELECT * FROM ride_requests WHERE id = ?', (ride_id,))
     return c.fetchone()
 
 def get_pending_ride_requests():
-    current_time = datetime.now().time().strftime('%H:%M')
-    next_departure_times = ['07:15', '09:15', '11:15', '13:15', '15:15', '17:15', '19:15']  # Add more as needed
+    conn, c = db()
+    current_time = clock.now().time().strftime('%H:%M')
     
     logger.debug(f"Current time: {current_time}")
 
     # Find the next departure time
-    for departure_time in next_departure_times:
-        if current_time < departure_time:
-            # Get pending requests before the next departure time
-            c.execute('''
-                SELECT * FROM ride_requests
-                WHERE status = 'pending'
-                AND time <= ?
-                ORDER BY time ASC
-            ''', (departure_time,))
-            return c.fetchall()
-    
-    return []
+    departure_time = next_departure(current_time)
+    if departure_time == 'unscheduled':
+        return []
+
+    # Get pending requests before the next departure time
+    c.execute('''
+        SELECT * FROM ride_requests
+        WHERE status = 'pending'
+        AND time <= ?
+        ORDER BY time ASC, location_id ASC
+    ''', (departure_time,))
+    return c.fetchall()
 
 def user_can_book_ride(user_id, time):
+    conn, c = db()
     c.execute('''
         SELECT * FROM ride_requests
         WHERE user_id = ? AND time = ? AND status = 'pending'
@@ -56,6 +211,7 @@ def user_can_book_ride(user_id, time):
     return c.fetchone() is None
 
 def get_user_pending_rides(user_id):
+    conn, c = db()
     c.execute('''
         SELECT * FROM ride_requests
         WHERE user_id = ? AND status = 'pending'
@@ -63,39 +219,404 @@ def get_user_pending_rides(user_id):
     ''', (user_id,))
     return c.fetchall()
 
-def cancel_ride(ride_id):
+# Ride state transitions. Each one is a single conditional UPDATE, so two
+# people tapping buttons at the same time can never both win: the loser's
+# statement simply matches no row.
+#
+# owner_id restricts the update to rides booked by that Telegram user.
+# booked_by restricts it to rides that Telegram user booked with /ride_for
+# (user_id is a name).
+def _transition_ride(ride_id, status, owner_id=None, booked_by=None):
+    conn, c = db()
     c.execute('''
-        DELETE FROM ride_requests
-        WHERE id = ?
-    ''', (ride_id,))
+        UPDATE ride_requests
+        SET status = ?
+        WHERE id = ? AND status = 'pending'
+        AND (? IS NULL OR user_id = ?)
+        AND (? IS NULL OR (user_id GLOB '*[^0-9]*' AND booked_by = ?))
+        RETURNING *
+    ''', (status, ride_id, owner_id, None if owner_id is None else str(owner_id),
+          booked_by, None if booked_by is None else str(booked_by)))
+    ride = c.fetchone()
+    if ride:
+        record_ride_stats([ride], status)
     conn.commit()
+    if ride:
+        logger.info(f'Ride {ride_id} marked as {status}')
+    return ride
 
-def mark_ride_completed(ride_id):
-    c.execute('UPDATE ride_requests SET status = ? WHERE id = ?', ('completed', ride_id))
+def _transition_latest_ride(user_id, status):
+    conn, c = db()
+    c.execute('''
+        UPDATE ride_requests
+        SET status = ?
+        WHERE status = 'pending' AND id = (
+            SELECT id FROM ride_requests
+            WHERE user_id = ? AND status = 'pending'
+            ORDER BY time DESC
+            LIMIT 1
+        )
+        RETURNING *
+    ''', (status, str(user_id)))
+    ride = c.fetchone()
+    if ride:
+        record_ride_stats([ride], status)
     conn.commit()
+    if ride:
+        logger.info(f'Ride {ride[0]} marked as {status}')
+    return ride
 
-def auto_complete_rides():
-    now = datetime.now()
-    current_time_str = now.strftime('%H:%M')
-    next_departure_times = ['07:15', '09:15', '11:15', '13:15', '15:15', '17:15', '19:15']  # Add more as needed
+def cancel_ride(ride_id, owner_id=None, booked_by=None):
+    return _transition_ride(ride_id, 'cancelled', owner_id, booked_by)
 
-    # Find the previous departure time
-    previous_departure_time = '00:00'
-    for departure_time in next_departure_times:
-        if current_time_str < departure_time:
-            break
-        previous_departure_time = departure_time
+def mark_ride_completed(ride_id, owner_id=None, booked_by=None):
+    return _transition_ride(ride_id, 'completed', owner_id, booked_by)
 
-    cutoff_time = (now - timedelta(minutes=40)).strftime('%H:%M')
-    
-    c.execute('''
+def cancel_latest_ride(user_id):
+    return _transition_latest_ride(user_id, 'cancelled')
+
+def complete_latest_ride(user_id):
+    return _transition_latest_ride(user_id, 'completed')
+
+def is_booked_on_behalf(ride):
+    # Rides booked with /ride_for store the colleague's name instead of a user id
+    return not str(ride[1]).isdigit()
+
+# Rides are completed automatically this long after their requested time
+AUTO_COMPLETE_GRACE = timedelta(minutes=40)
+
+# Each tenant keeps a min-heap of (deadline, ride_id) for its pending rides. A
+# single job_queue job per tenant is armed for the earliest deadline, so
+# nothing runs until a ride is actually due.
+auto_complete_queue = None
+
+def auto_complete_deadline(time):
+    requested_time = datetime.strptime(time, '%H:%M').time()
+    return datetime.combine(clock.now().date(), requested_time) + AUTO_COMPLETE_GRACE
+
+def schedule_auto_complete(ride_id, time):
+    heapq.heappush(tenants.current().auto_complete_heap, (auto_complete_deadline(time), ride_id))
+    arm_auto_complete_job()
+
+def arm_auto_complete_job():
+    tenant = tenants.current()
+    if auto_complete_queue is None or not tenant.auto_complete_heap:
+        return
+
+    deadline = tenant.auto_complete_heap[0][0]
+    if tenant.auto_complete_job is not None:
+        if tenant.auto_complete_job.data[1] <= deadline:
+            return  # Already waking up early enough
+        tenant.auto_complete_job.schedule_removal()
+
+    # Pass an absolute time so the job also fires on the replay tool's virtual clock
+    when = max(deadline, clock.now()).astimezone()
+    tenant.auto_complete_job = auto_complete_queue.run_once(
+        auto_complete_rides_wrapper, when=when, data=(tenant, deadline), name=f'auto_complete_rides_{tenant.id}'
+    )
+
+def start_auto_complete(job_queue):
+    global auto_complete_queue
+    auto_complete_queue = job_queue
+
+    for tenant in tenants.tenants:
+        with tenants.use(tenant):
+            rebuild_auto_complete_heap()
+
+def rebuild_auto_complete_heap():
+    # Rebuild the heap from the database so rides survive a restart
+    conn, c = db()
+    tenant = tenants.current()
+
+    c.execute("SELECT id, time FROM ride_requests WHERE status = 'pending'")
+    tenant.auto_complete_heap = []
+    for ride_id, time in c.fetchall():
+        try:
+            tenant.auto_complete_heap.append((auto_complete_deadline(time), ride_id))
+        except ValueError:
+            logger.warning(f'Ride {ride_id} has an invalid time {time}, it will not be auto-completed')
+    heapq.heapify(tenant.auto_complete_heap)
+    logger.info(f'Auto-completion scheduled for {len(tenant.auto_complete_heap)} pending rides of {tenant.id}')
+
+    arm_auto_complete_job()
+
+def auto_complete_rides(now=None):
+    conn, c = db()
+    heap = tenants.current().auto_complete_heap
+    now = now or clock.now()
+
+    due = []
+    while heap and heap[0][0] <= now:
+        deadline, ride_id = heapq.heappop(heap)
+        # Ride ids restart after the midnight reset, so drop entries left over from a previous day
+        if (deadline - AUTO_COMPLETE_GRACE).date() == now.date():
+            due.append(ride_id)
+
+    if not due:
+        return []
+
+    placeholders = ', '.join('?' * len(due))
+    c.execute(f'''
         UPDATE ride_requests
         SET status = 'completed'
         WHERE status = 'pending'
-        AND time <= ?
-        AND time >= ?
-    ''', (cutoff_time, previous_departure_time))
+        AND id IN ({placeholders})
+        RETURNING *
+    ''', due)
+    rides = c.fetchall()
+    record_ride_stats(rides, 'completed')
+    conn.commit()
+    completed = [ride[0] for ride in rides]
+    logger.info(f'Auto-completed rides: {completed}')
+    return completed
+
+async def auto_complete_rides_wrapper(context: CallbackContext):
+    tenant, _ = context.job.data
+    with tenants.use(tenant):
+        tenant.auto_complete_job = None
+        auto_complete_rides()
+        arm_auto_complete_job()
+
+# Standing bookings. days holds the weekday numbers the ride repeats on
+# (Monday is 0), e.g. '01234' for every weekday.
+def overlapping_recurring_ride(user_id, days, time):
+    # A subscription of the user at the same time on one of these days. Two of
+    # them would book two pending rides at the same time.
+    conn, c = db()
+    c.execute('''
+        SELECT * FROM recurring_rides
+        WHERE user_id = ? AND time = ?
+        ORDER BY id ASC
+    ''', (str(user_id), time))
+    for recurring in c.fetchall():
+        if set(recurring[2]) & set(days):
+            return recurring
+    return None
+
+def add_recurring_ride(user_id, days, location_id, destination_id, time, purpose):
+    conn, c = db()
+    if overlapping_recurring_ride(user_id, days, time) is not None:
+        return None
+    c.execute('''
+        INSERT INTO recurring_rides (user_id, days, location_id, destination_id, time, purpose)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', (user_id, days, location_id, destination_id, time, purpose))
+    conn.commit()
+    logger.info(f'Saved recurring ride: user_id={user_id}, days={days}, location_id={location_id}, destination_id={destination_id}, time={time}, purpose={purpose}')
+    return c.lastrowid
+
+def get_user_recurring_rides(user_id):
+    conn, c = db()
+    c.execute('''
+        SELECT * FROM recurring_rides
+        WHERE user_id = ?
+        ORDER BY time ASC
+    ''', (str(user_id),))
+    return c.fetchall()
+
+def remove_recurring_ride(recurring_id, user_id):
+    conn, c = db()
+    c.execute('''
+        DELETE FROM recurring_rides
+        WHERE id = ? AND user_id = ?
+        RETURNING id
+    ''', (recurring_id, str(user_id)))
+    removed = c.fetchone() is not None
+    conn.commit()
+    return removed
+
+def skip_recurring_ride(recurring_id, user_id, date):
+    conn, c = db()
+    c.execute('''
+        UPDATE recurring_rides
+        SET skip_date = ?
+        WHERE id = ? AND user_id = ?
+        RETURNING id
+    ''', (date.isoformat(), recurring_id, str(user_id)))
+    skipped = c.fetchone() is not None
+    conn.commit()
+    return skipped
+
+# Recurring rides of the date that still need booking, with the departure slot
+# each falls into and its seat number in that slot after the pending rides
+RECURRING_CANDIDATES = '''
+    WITH matching AS (
+        SELECT r.*, departure_slot(r.time) AS slot,
+               ROW_NUMBER() OVER (PARTITION BY r.user_id, r.time ORDER BY r.id) AS duplicate
+        FROM recurring_rides r
+        WHERE instr(r.days, :weekday) > 0
+        AND (r.skip_date IS NULL OR r.skip_date != :date)
+        AND NOT EXISTS (
+            SELECT 1 FROM ride_requests q
+            WHERE q.user_id = r.user_id AND q.time = r.time
+        )
+    ), candidates AS (
+        -- One ride per user and time, as user_can_book_ride allows, from the
+        -- oldest of overlapping subscriptions saved before they were refused
+        SELECT id, user_id, days, location_id, destination_id, time, purpose, skip_date, slot
+        FROM matching
+        WHERE duplicate = 1
+    ), taken AS (
+        SELECT departure_slot(time) AS slot, COUNT(*) AS seats
+        FROM ride_requests
+        WHERE status = 'pending'
+        GROUP BY 1
+    ), seated AS (
+        SELECT c.*, COALESCE(t.seats, 0) + ROW_NUMBER() OVER (PARTITION BY c.slot ORDER BY c.id) AS seat
+        FROM candidates c LEFT JOIN taken t ON t.slot = c.slot
+    )
+'''
+
+def book_recurring_rides(date):
+    # Returns the booked rides, and the recurring rides refused because their
+    # departure was full
+    conn, c = db()
+    conn.create_function('departure_slot', 1, departure_slot)
+    capacity = tenants.current().capacity
+    parameters = {'weekday': str(date.weekday()), 'date': date.isoformat(), 'capacity': capacity}
+    # Materialize the day's standing bookings in one transaction. Subscriptions
+    # skipped for this date, and users who already have a ride (pending,
+    # completed or canceled) at that time today, are left alone. Seats left in
+    # a departure go to the oldest subscriptions first.
+    c.execute(RECURRING_CANDIDATES + '''
+        INSERT INTO ride_requests (user_id, location_id, destination_id, time, purpose)
+        SELECT user_id, location_id, destination_id, time, purpose
+        FROM seated
+        WHERE :capacity IS NULL OR slot = 'unscheduled' OR seat <= :capacity
+        ORDER BY time ASC
+        RETURNING *
+    ''', parameters)
+    rides = c.fetchall()
+    # Whatever is still unbooked found its departure full
+    c.execute(RECURRING_CANDIDATES + 'SELECT id, user_id, days, location_id, destination_id, time, purpose, skip_date, slot FROM seated ORDER BY time ASC', parameters)
+    refused = c.fetchall()
+    record_ride_stats(rides, 'requested')
     conn.commit()
+    logger.info(f'Booked {len(rides)} recurring rides for {date}, {len(refused)} refused for full departures')
+
+    for ride in rides:
+        heapq.heappush(tenants.current().auto_complete_heap, (auto_complete_deadline(ride[4]), ride[0]))
+    arm_auto_complete_job()
+    return rides, refused
+
+def departure_slot(time):
+    time = datetime.strptime(time, '%H:%M').strftime('%H:%M')
+    for departure_time in tenants.current().departure_times:
+        if time <= departure_time:
+            return departure_time
+    return 'unscheduled'
+
+def next_departure(time):
+    # The first departure after time, a departure leaving right now is gone
+    for departure_time in tenants.current().departure_times:
+        if time < departure_time:
+            return departure_time
+    return 'unscheduled'
+
+def current_slot():
+    # The departure the drivers are serving now. One that left less than
+    # AUTO_COMPLETE_GRACE ago and still has pending rides is still on its way,
+    # otherwise it is the next departure, as in get_pending_ride_requests.
+    now = clock.now()
+    current_time = now.strftime('%H:%M')
+    left_since = (now - AUTO_COMPLETE_GRACE).strftime('%H:%M') if (now - AUTO_COMPLETE_GRACE).date() == now.date() else '00:00'
+    departed = [departure_time for departure_time in tenants.current().departure_times if departure_time <= current_time]
+    if departed and departed[-1] >= left_since and get_slot_pending_rides(departed[-1]):
+        return departed[-1]
+    return next_departure(current_time)
+
+def served_slot():
+    # The departure the bus is on its way to: the one the drivers set off for
+    # with /en_route, until its grace window is over, otherwise current_slot()
+    en_route_slot = tenants.current().en_route_slot
+    if en_route_slot is not None:
+        date, slot = en_route_slot
+        departure = datetime.combine(date, datetime.strptime(slot, '%H:%M').time())
+        if clock.now() <= departure + AUTO_COMPLETE_GRACE:
+            return slot
+    return current_slot()
+
+def slot_bounds(slot):
+    # Ride times (previous departure, slot] are served by the slot's departure
+    departure_times = tenants.current().departure_times
+    index = departure_times.index(slot)
+    return departure_times[index - 1] if index > 0 else '', slot
+
+def get_slot_pending_rides(slot):
+    conn, c = db()
+    c.execute('''
+        SELECT * FROM ride_requests
+        WHERE status = 'pending'
+        AND time > ? AND time <= ?
+        ORDER BY time ASC, location_id ASC
+    ''', slot_bounds(slot))
+    return c.fetchall()
+
+def slot_is_full(time):
+    # Whether the departure this ride time falls into has no seats left
+    conn, c = db()
+    tenant = tenants.current()
+    slot = departure_slot(time)
+    if not tenant.capacity or slot == 'unscheduled':
+        return False
+
+    c.execute('''
+        SELECT COUNT(*) FROM ride_requests
+        WHERE status = 'pending'
+        AND time > ? AND time <= ?
+    ''', slot_bounds(slot))
+    return c.fetchone()[0] >= tenant.capacity
+
+# Riders who blocked the bot are skipped by direct message fan-outs until
+# they book a ride again
+def get_blocked_users():
+    conn, c = db()
+    c.execute('SELECT user_id FROM blocked_users')
+    return {row[0] for row in c.fetchall()}
+
+def mark_users_blocked(user_ids):
+    conn, c = db()
+    blocked_at = clock.now().isoformat(timespec='seconds')
+    c.executemany('INSERT OR IGNORE INTO blocked_users (user_id, blocked_at) VALUES (?, ?)',
+                  [(str(user_id), blocked_at) for user_id in user_ids])
+    conn.commit()
+
+# Ride analytics are kept as rollups in ride_stats, one row per
+# date x slot x purpose x route. They are updated in the same transaction as
+# the ride write (callers commit), and survive the midnight reset.
+# column is one of 'requested', 'completed' or 'cancelled'.
+def record_ride_stats(rides, column):
+    conn, c = db()
+    date = clock.now().date().isoformat()
+    c.executemany(f'''
+        INSERT INTO ride_stats (date, slot, purpose, location_id, destination_id, {column})
+        VALUES (?, ?, ?, ?, ?, 1)
+        ON CONFLICT (date, slot, purpose, location_id, destination_id)
+        DO UPDATE SET {column} = {column} + 1
+    ''', [(date, departure_slot(ride[4]), ride[5], ride[2], ride[3]) for ride in rides])
+
+STATS_GROUPS = {
+    'slot': 'slot',
+    'purpose': 'purpose',
+    'route': "location_id || ',' || destination_id",
+}
+
+def get_ride_stats(start_date, end_date, group_by=None):
+    conn, c = db()
+    # Reads only the rollups, never ride_requests
+    key = STATS_GROUPS[group_by] if group_by else "'total'"
+    c.execute(f'''
+        SELECT {key}, SUM(requested), SUM(completed), SUM(cancelled)
+        FROM ride_stats
+        WHERE date BETWEEN ? AND ?
+        GROUP BY 1
+        ORDER BY 2 DESC, 1 ASC
+    ''', (start_date.isoformat(), end_date.isoformat()))
+    rows = c.fetchall()
+    if group_by == 'route':
+        rows = [(route_name(row[0]),) + row[1:] for row in rows]
+    return rows
 
-def auto_complete_rides_wrapper(context: CallbackContext):
-    auto_complete_rides()
+def route_name(route):
+    location_id, destination_id = route.split(',')
+    return f'{stops.stop_name(int(location_id))} → {stops.stop_name(int(destination_id))}'
@@ -1,8 +1,8 @@
 import logging
-import sqlite3
-from datetime import datetime, timezone
-from telegram import Update, ForceReply, Bot, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, ContextTypes, CallbackContext, CallbackQueryHandler
+from datetime import datetime, time, timedelta, timezone
+from functools import wraps
+from telegram import Update, ForceReply, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.ext import Application, CommandHandler, ContextTypes, CallbackContext, CallbackQueryHandler, MessageHandler, TypeHandler, filters
 from telegram.error import BadRequest
 import ride_manager as rm
 import subprocess
@@ -10,14 +10,20 @@ import sys
 import os
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 import notifications
+import bot_client
+import stops
+import tenants
+from collections import Counter
 import asyncio
+import clock
+import update_recorder
+import live_eta
+import fanout
+import backup
 
 # Get the path to the Python interpreter in your virtual environment
 python_executable = sys.executable
 
-# Start the database reset scheduler as a separate process using the virtual environment's Python interpreter
-subprocess.Popen([python_executable, "reset_database.py"])
-
 # Enable logging
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -25,42 +31,25 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Database setup
-conn = sqlite3.connect('rides.db', check_same_thread=False)
-c = conn.cursor()
-c.execute('''
-    CREATE TABLE IF NOT EXISTS ride_requests (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id TEXT NOT NULL,
-        location TEXT NOT NULL,
-        destination TEXT NOT NULL,
-        time TEXT NOT NULL,
-        purpose TEXT NOT NULL,
-        status TEXT DEFAULT 'pending'
-    )
-''')
-conn.commit()
-
-# Initialize your bot with the token from environment variable
-bot_token = os.getenv('BOT_TOKEN')
-if not bot_token:
-    raise RuntimeError('BOT_TOKEN environment variable is not set.')
-
-bot = Bot(bot_token)
-
 PORT = int(os.getenv('PORT',8080))
 
-# Define allowed group chat IDs
-ALLOWED_GROUP_CHAT_IDS = ["-XXXXXXXXXX", "-XXXXXXXXXX"]
+def is_allowed_group(update: Update) -> bool:
+    """Check if the message is from a group of one of the configured tenants."""
+    tenant = tenants.tenant_for_chat(update.effective_chat.id)
+    return tenant is not None and update.effective_chat.id in tenant.group_chat_ids
 
-# Define the group chat IDs
-DRIVERS_GROUP_CHAT_ID = -XXXXXXXXXX
-STUDENTS_GROUP_CHAT_ID = -XXXXXXXXXX
+def is_drivers_chat(update: Update) -> bool:
+    tenant = tenants.current()
+    return tenant is not None and update.effective_chat.id == tenant.drivers_chat_id
 
-def is_allowed_group(update: Update) -> bool:
-    """Check if the message is from an allowed group."""
-    chat_id = str(update.effective_chat.id)
-    return chat_id in ALLOWED_GROUP_CHAT_IDS
+# Run a handler against the tenant that owns the chat, so ride_manager uses its database and timetable
+def tenant_scope(func):
+    @wraps(func)
+    async def wrapper(update: Update, context: CallbackContext, *args, **kwargs):
+        with tenants.use(tenants.tenant_for_chat(update.effective_chat.id)):
+            await func(update, context, *args, **kwargs)
+
+    return wrapper
 
 # Initialize the scheduler
 scheduler = AsyncIOScheduler()
@@ -70,10 +59,11 @@ driver_start_job_id = 'workday_start_notification_drivers'
 driver_end_job_id = 'workday_end_notification_drivers'
 student_start_job_id = 'workday_start_notification_students'
 student_end_job_id = 'workday_end_notification_students'
+recurring_rides_job_id = 'book_recurring_rides'
 
 # Function to enable or disable jobs based on the current day
 def manage_weekend_jobs():
-    current_day = datetime.now().weekday()  # Monday is 0, Sunday is 6
+    current_day = clock.now().weekday()  # Monday is 0, Sunday is 6
 
     if current_day in [5, 6]:  # If it's Saturday (5) or Sunday (6)
         # Disable the jobs
@@ -81,23 +71,25 @@ def manage_weekend_jobs():
         scheduler.pause_job(driver_end_job_id)
         scheduler.pause_job(student_start_job_id)
         scheduler.pause_job(student_end_job_id)
+        scheduler.pause_job(recurring_rides_job_id)
     else:
         # Enable the jobs
         scheduler.resume_job(driver_start_job_id)
         scheduler.resume_job(driver_end_job_id)
         scheduler.resume_job(student_start_job_id)
         scheduler.resume_job(student_end_job_id)
+        scheduler.resume_job(recurring_rides_job_id)
 
 async def clear_messages():
-    for chat_id in ALLOWED_GROUP_CHAT_IDS:
+    for chat_id in [chat_id for tenant in tenants.tenants for chat_id in tenant.group_chat_ids]:
         try:
             message_ids = []
-            async for message in bot.get_chat_history(chat_id):
+            async for message in bot_client.bot.get_chat_history(chat_id):
                 message_ids.append(message.message_id)
                 if len(message_ids) % 100 == 0:  # Clear in chunks of 100
                     for message_id in message_ids:
                         try:
-                            await bot.delete_message(chat_id, message_id)
+                            await bot_client.bot.delete_message(chat_id, message_id)
                             print("Messages cleared successfully.")
                         except BadRequest as e:
                             print(f"Failed to delete message {message_id} in chat {chat_id}: {e}")
@@ -106,7 +98,7 @@ async def clear_messages():
             # Clear remaining messages
             for message_id in message_ids:
                 try:
-                    await bot.delete_message(chat_id, message_id)
+                    await bot_client.bot.delete_message(chat_id, message_id)
                     print("All messages cleared successfully.")
                 except BadRequest as e:
                     print(f"Failed to delete message {message_id} in chat {chat_id}: {e}")
@@ -114,6 +106,38 @@ async def clear_messages():
         except Exception as e:
             print(f"Error clearing messages in chat {chat_id}: {e}")
 
+# Book the day's recurring rides in bulk and send each rider one message with
+# what was booked and what was refused because the departure is full
+async def book_recurring_rides():
+    rides = []
+    refused = []
+    for tenant in tenants.tenants:
+        with tenants.use(tenant):
+            tenant_rides, tenant_refused = rm.book_recurring_rides(clock.now().date())
+        rides += tenant_rides
+        refused += tenant_refused
+
+    rides_by_user = {}
+    for ride in rides:
+        rides_by_user.setdefault(ride[1], ([], []))[0].append(ride)
+    for recurring in refused:
+        rides_by_user.setdefault(recurring[1], ([], []))[1].append(recurring)
+
+    for user_id, (user_rides, user_refused) in rides_by_user.items():
+        message = ""
+        if user_rides:
+            message += "🚌 Your recurring rides for today have been booked:\n"
+        for ride in user_rides:
+            message += f"- From {stops.stop_name(ride[2])} to {stops.stop_name(ride[3])} at {ride[4]} for {ride[5]} (ID: {ride[0]})\n"
+        if user_refused:
+            message += "⚠️ These recurring rides could not be booked today, their departure is full:\n"
+        for recurring in user_refused:
+            message += f"- From {stops.stop_name(recurring[3])} to {stops.stop_name(recurring[4])} at {recurring[5]} ({recurring[8]} departure). Please book another time with /ride.\n"
+        try:
+            await bot_client.bot.send_message(int(user_id), message)
+        except Exception as e:
+            logger.error(f"Error sending recurring ride confirmation to {user_id}: {e}")
+
 # Schedule workday start and end notifications for drivers
 scheduler.add_job(
     notifications.notify_workday_start_drivers,
@@ -148,6 +172,24 @@ scheduler.add_job(
     id=student_end_job_id
 )
 
+# Schedule the recurring rides booking at the start of the workday
+scheduler.add_job(
+    book_recurring_rides,
+    trigger='cron',
+    hour=6,
+    minute=0,
+    id=recurring_rides_job_id
+)
+
+# Snapshot the tenant databases while the bot keeps running, when BACKUP_DIR is set
+if backup.snapshots_enabled():
+    scheduler.add_job(
+        backup.snapshot_all,
+        trigger='interval',
+        minutes=backup.BACKUP_INTERVAL_MINUTES,
+        id='snapshot_databases'
+    )
+
 # Schedule the weekend management job to run daily at midnight
 scheduler.add_job(
     manage_weekend_jobs,
@@ -166,9 +208,6 @@ scheduler.add_job(
     id='clear_messages_job'
 )
 
-# Start the scheduler
-scheduler.start()
-
 # Global variable to control notification state
 notifications_paused = False
 
@@ -189,8 +228,8 @@ async def manage_notifications_based_on_hours():
     global notifications_paused
 
     while True:
-        now = datetime.now(timezone.utc).time()
-        current_day = datetime.now(timezone.utc).weekday()
+        now = clock.now(timezone.utc).time()
+        current_day = clock.now(timezone.utc).weekday()
         start_time = time(20, 0)
         end_time = time(6, 0)
         
@@ -216,7 +255,7 @@ async def manage_notifications_based_on_hours():
                     notifications_paused = False
 
         logger.info(f"[DEBUG] Current time: {now}, Start time: {start_time}, End time: {end_time}, Notifications paused: {notifications_paused}")
-        await asyncio.sleep(60)  # Check every minute
+        await clock.sleep(60)  # Check every minute
 
 # Start the coroutine for managing notifications
 async def start_tasks():
@@ -225,9 +264,19 @@ async def start_tasks():
 WORKDAY_ENDED_MESSAGE = "The workday has ended. Please note that requests will be processed during the next workday."
 WEEKEND_MESSAGE = "Sorry! The bot does not process requests on weekends. 👌"
 
+async def reply_restriction(update: Update, message) -> None:
+    # Button taps have no update.message, answer the tap and show the reason
+    # in place of the buttons
+    if update.callback_query is not None:
+        await update.callback_query.answer()
+        await update.callback_query.edit_message_text(message)
+    else:
+        await update.message.reply_text(message)
+
 def workday_check(func):
+    @wraps(func)
     async def wrapper(update: Update, context: CallbackContext, *args, **kwargs):
-        now = datetime.now()
+        now = clock.now()
         current_time = now.time()
         current_day = now.weekday()  # Monday is 0 and Sunday is 6
 
@@ -237,11 +286,11 @@ def workday_check(func):
         # Check if today is Saturday (5) or Sunday (6)
         if current_day in [5, 6]:
             print(f"[DEBUG] Current day: {current_day}, Weekend restriction applied.")
-            await update.message.reply_text(WEEKEND_MESSAGE)
+            await reply_restriction(update, WEEKEND_MESSAGE)
         # Check if current time is within the restricted period
         elif start_time <= current_time or current_time < end_time:
             print(f"[DEBUG] Current time: {current_time}, Restriction applied.")
-            await update.message.reply_text(WORKDAY_ENDED_MESSAGE)
+            await reply_restriction(update, WORKDAY_ENDED_MESSAGE)
         else:
             print(f"[DEBUG] Current time: {current_time}, No restriction.")
             await func(update, context, *args, **kwargs)
@@ -261,6 +310,81 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         reply_markup=ForceReply(selective=True),
     )
 
+# Resolve a booking's location and destination to stop ids. When one is
+# unknown or ambiguous, the booking is parked in user_data and the rider picks
+# the stop from an inline keyboard, which only requester_id may use. Returns
+# True once both are resolved.
+async def resolve_booking_stops(reply, context: ContextTypes.DEFAULT_TYPE, booking, requester_id) -> bool:
+    for field in ['location', 'destination']:
+        if isinstance(booking[field], int):
+            continue
+
+        stop_id, suggestions = stops.resolve(booking[field])
+        if stop_id is not None:
+            booking[field] = stop_id
+            continue
+
+        if not suggestions:
+            context.user_data.pop('pending_ride', None)
+            await reply(f"Unknown stop '{booking[field]}'. Available stops: {', '.join(stops.stop_names())}.")
+            return False
+
+        context.user_data['pending_ride'] = booking
+        keyboard = [[InlineKeyboardButton(stops.stop_name(suggestion), callback_data=f'ride_stop_{field}_{suggestion}_{requester_id}')] for suggestion in suggestions]
+        await reply(f"Which stop did you mean by '{booking[field]}'?", reply_markup=InlineKeyboardMarkup(keyboard))
+        return False
+
+    return True
+
+async def save_booking(reply, booking) -> None:
+    name = booking['name']
+    location = stops.stop_name(booking['location'])
+    destination = stops.stop_name(booking['destination'])
+    time = booking['time']
+    purpose = booking['purpose']
+
+    if rm.slot_is_full(time):
+        await reply(f'Sorry, the departure for {time} is full. Please choose another time.')
+        return
+
+    # Save the ride request to the database
+    ride_id = rm.save_ride_request(booking['user_id'], booking['location'], booking['destination'], time, purpose, booking['booked_by'])
+
+    if name is None:
+        if ride_id:
+            await reply(f'Ride requested from {location} to {destination} at {time} for {purpose}. Your ride ID is {ride_id}.')
+        else:
+            await reply(f'You already have a ride booked for {time}. Please cancel the current request before booking a new one.')
+    else:
+        if ride_id:
+            await reply(f'Ride requested from {location} to {destination} at {time} for {purpose} on behalf of {name}. Your ride ID is {ride_id}.')
+        else:
+            await reply(f'{name} already has a ride booked for {time}. Please cancel the current request before booking a new one.')
+
+async def book_ride(update: Update, context: ContextTypes.DEFAULT_TYPE, booking) -> None:
+    if await resolve_booking_stops(update.message.reply_text, context, booking, update.effective_user.id):
+        await save_booking(update.message.reply_text, booking)
+
+@tenant_scope
+@workday_check
+async def ride_stop_choice(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    parts = query.data.split('_')
+    booking = context.user_data.get('pending_ride')
+    if (booking is None or len(parts) != 5 or parts[2] not in ['location', 'destination']
+            or not parts[3].isdigit() or int(parts[3]) not in stops.stops_by_id
+            or not parts[4].isdigit() or query.from_user.id != int(parts[4])):
+        await query.answer('This choice has expired or belongs to someone else.')
+        return
+
+    await query.answer()
+    booking[parts[2]] = int(parts[3])
+
+    if await resolve_booking_stops(query.edit_message_text, context, booking, query.from_user.id):
+        context.user_data.pop('pending_ride', None)
+        await save_booking(query.edit_message_text, booking)
+
+@tenant_scope
 @workday_check
 async def ride(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not is_allowed_group(update):
@@ -286,27 +410,23 @@ async def ride(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
             return
 
         # Combine with current date and convert to UTC
-        current_date = datetime.now().date()
+        current_date = clock.now().date()
         requested_datetime = datetime.combine(current_date, requested_time.time(), tzinfo=timezone.utc)
 
         # Get current time in UTC
-        current_time_utc = datetime.now(timezone.utc)
+        current_time_utc = clock.now(timezone.utc)
 
         # Check if the requested time is in the past
         if requested_datetime < current_time_utc:
             await update.message.reply_text('You cannot request a ride in the past. Please provide a valid time.')
             return
 
-        # Save the ride request to the database
-        ride_id = rm.save_ride_request(update.effective_user.id, location, destination, time, purpose)
-
-        if ride_id:
-            await update.message.reply_text(f'Ride requested from {location} to {destination} at {time} for {purpose}. Your ride ID is {ride_id}.')
-        else:
-            await update.message.reply_text(f'You already have a ride booked for {time}. Please cancel the current request before booking a new one.')
+        booking = {'user_id': update.effective_user.id, 'name': None, 'booked_by': None, 'location': location, 'destination': destination, 'time': requested_time.strftime("%H:%M"), 'purpose': purpose}
+        await book_ride(update, context, booking)
     except IndexError:
         await update.message.reply_text('Usage: /ride [Location] [Destination] [Time] [Purpose (class/switch/closed/other)]')
 
+@tenant_scope
 @workday_check
 async def ride_for(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not is_allowed_group(update):
@@ -337,40 +457,160 @@ async def ride_for(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
             return
 
         # Combine with current date and convert to UTC
-        current_date = datetime.now().date()
+        current_date = clock.now().date()
         requested_datetime = datetime.combine(current_date, requested_time.time(), tzinfo=timezone.utc)
 
         # Get current time in UTC
-        current_time_utc = datetime.now(timezone.utc)
+        current_time_utc = clock.now(timezone.utc)
 
         # Check if the requested time is in the past
         if requested_datetime < current_time_utc:
             await update.message.reply_text('You cannot request a ride in the past. Please provide a valid time.')
             return
 
-        # Save the ride request to the database
-        ride_id = rm.save_ride_request(name, location, destination, time, purpose)
-
-        if ride_id:
-            await update.message.reply_text(f'Ride requested from {location} to {destination} at {time} for {purpose} on behalf of {name}. Your ride ID is {ride_id}.')
-        else:
-            await update.message.reply_text(f'{name} already has a ride booked for {time}. Please cancel the current request before booking a new one.')
+        booking = {'user_id': name, 'name': name, 'booked_by': update.effective_user.id, 'location': location, 'destination': destination, 'time': requested_time.strftime("%H:%M"), 'purpose': purpose}
+        await book_ride(update, context, booking)
     except IndexError:
         await update.message.reply_text('Usage: /ride_for [Name] [Location] [Destination] [Time] [Purpose (class/switch/closed/other)]')
 
-# Track the state of pending ride requests
-previous_pending_requests = set()
-previous_message = ""
+WEEKDAYS = ['mon', 'tue', 'wed', 'thu', 'fri']
+RIDE_RECURRING_USAGE = (
+    'Usage: /ride_recurring [Days] [Location] [Destination] [Time] [Purpose (class/switch/closed/other)]\n'
+    'Days can be weekdays, a range like mon-thu or a list like mon,wed,fri.\n'
+    '/ride_recurring - List your recurring rides.\n'
+    '/ride_recurring stop [ID] - Stop a recurring ride.\n'
+    '/ride_recurring skip [ID] - Skip a recurring ride on the next workday.'
+)
+
+# Convert a weekday pattern to the weekday numbers stored with the subscription, e.g. mon-wed -> '012'
+def parse_weekdays(pattern):
+    pattern = pattern.lower()
+    if pattern == 'weekdays':
+        return '01234'
+
+    days = set()
+    for part in pattern.split(','):
+        if '-' in part:
+            first, last = part.split('-', 1)
+            days.update(range(WEEKDAYS.index(first[:3]), WEEKDAYS.index(last[:3]) + 1))
+        else:
+            days.add(WEEKDAYS.index(part[:3]))
 
+    if not days:
+        raise ValueError(pattern)
+    return ''.join(str(day) for day in sorted(days))
+
+def format_weekdays(days):
+    return ','.join(WEEKDAYS[int(day)] for day in days)
+
+def next_workday(date):
+    date += timedelta(days=1)
+    while date.weekday() in [5, 6]:
+        date += timedelta(days=1)
+    return date
+
+@tenant_scope
 @workday_check
+async def ride_recurring(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not is_allowed_group(update):
+        await update.message.reply_text('This bot is restricted to specific groups.')
+        return
+
+    user_id = update.effective_user.id
+    details = context.args
+
+    if not details:
+        recurring_rides = rm.get_user_recurring_rides(user_id)
+        if not recurring_rides:
+            await update.message.reply_text('You have no recurring rides.')
+            return
+
+        message = "🔁 Your Recurring Rides:\n\n"
+        for ride in recurring_rides:
+            message += f"- {format_weekdays(ride[2])}: From {stops.stop_name(ride[3])} to {stops.stop_name(ride[4])} at {ride[5]} for {ride[6]} (ID: {ride[0]})\n"
+        await update.message.reply_text(message)
+        return
+
+    if details[0].lower() in ['stop', 'skip']:
+        try:
+            recurring_id = int(details[1])
+        except (IndexError, ValueError):
+            await update.message.reply_text(RIDE_RECURRING_USAGE)
+            return
+
+        if details[0].lower() == 'stop':
+            if rm.remove_recurring_ride(recurring_id, user_id):
+                await update.message.reply_text(f'Recurring ride {recurring_id} has been stopped.')
+            else:
+                await update.message.reply_text(f'No such recurring ride ID {recurring_id} exists or it does not belong to you.')
+        else:
+            skip_date = next_workday(clock.now().date())
+            if rm.skip_recurring_ride(recurring_id, user_id, skip_date):
+                await update.message.reply_text(f'Recurring ride {recurring_id} will not be booked on {skip_date}.')
+            else:
+                await update.message.reply_text(f'No such recurring ride ID {recurring_id} exists or it does not belong to you.')
+        return
+
+    if len(details) < 5:
+        await update.message.reply_text(RIDE_RECURRING_USAGE)
+        return
+
+    location = details[1]
+    destination = details[2]
+    time = details[3]
+    purpose = details[4].lower()
+
+    try:
+        days = parse_weekdays(details[0])
+    except ValueError:
+        await update.message.reply_text('Days must be weekdays, e.g. weekdays, mon-thu or mon,wed,fri.')
+        return
+
+    if purpose not in ['class', 'switch', 'closed', 'other']:
+        await update.message.reply_text('Purpose must be one of: class, switch, closed, other.')
+        return
+
+    try:
+        time = datetime.strptime(time, "%H:%M").strftime("%H:%M")
+    except ValueError:
+        await update.message.reply_text('Invalid time format. Please provide time in HH:MM format (e.g., 14:30).')
+        return
+
+    # Recurring rides need unambiguous stops, there is no one to ask at 06:00
+    stop_ids = []
+    for stop in [location, destination]:
+        stop_id, suggestions = stops.resolve(stop)
+        if stop_id is None:
+            options = ', '.join(stops.stop_name(suggestion) for suggestion in suggestions) or ', '.join(stops.stop_names())
+            await update.message.reply_text(f"Unknown or ambiguous stop '{stop}'. Did you mean one of: {options}?")
+            return
+        stop_ids.append(stop_id)
+    location, destination = stops.stop_name(stop_ids[0]), stops.stop_name(stop_ids[1])
+
+    overlapping = rm.overlapping_recurring_ride(user_id, days, time)
+    if overlapping is not None:
+        await update.message.reply_text(f'You already have recurring ride {overlapping[0]} at {time} on {format_weekdays(overlapping[2])}. Stop it first with /ride_recurring stop {overlapping[0]}.')
+        return
+
+    recurring_id = rm.add_recurring_ride(user_id, days, stop_ids[0], stop_ids[1], time, purpose)
+    await update.message.reply_text(f'Recurring ride from {location} to {destination} at {time} for {purpose} on {format_weekdays(days)} saved. It will be booked at the start of each workday. Your recurring ride ID is {recurring_id}.')
+
+# Notify every tenant's drivers of its pending ride requests
 async def notify_drivers(context: CallbackContext) -> None:
     global notifications_paused
     if notifications_paused:
         return
 
-    global previous_pending_requests
-    global previous_message
-    
+    for tenant in tenants.tenants:
+        with tenants.use(tenant):
+            try:
+                await notify_tenant_drivers(context, tenant)
+            except Exception as e:
+                logger.error(f"Error notifying drivers of {tenant.id}: {e}")
+
+# Send one tenant's pending ride requests to its drivers chat. The state of
+# the last notification is kept on the tenant.
+async def notify_tenant_drivers(context: CallbackContext, tenant) -> None:
     pending_requests = rm.get_pending_ride_requests()
     logger.debug(f"Pending requests: {pending_requests}")
     
@@ -378,7 +618,7 @@ async def notify_drivers(context: CallbackContext) -> None:
     current_pending_requests = set(request[0] for request in pending_requests)
     
     # Check if there is any change in the pending requests
-    if current_pending_requests != previous_pending_requests:
+    if current_pending_requests != tenant.previous_pending_requests:
         high_priority_requests = []
         medium_priority_requests = []
         low_priority_requests = []
@@ -386,8 +626,8 @@ async def notify_drivers(context: CallbackContext) -> None:
         # Categorize pending requests
         for request in pending_requests:
             user_id = request[1]
-            location = request[2]
-            destination = request[3]
+            location = stops.stop_name(request[2])
+            destination = stops.stop_name(request[3])
             time = request[4]
             purpose = request[5].lower()
             
@@ -420,36 +660,75 @@ async def notify_drivers(context: CallbackContext) -> None:
             message += "Low Priority:\n"
             message += "\n".join(low_priority_requests) + "\n\n" if low_priority_requests else "None\n\n"
             
+            # Pickups per stop, grouped on the stop id
+            pickups = Counter(request[2] for request in pending_requests)
+            message += "Pickups per stop:\n"
+            message += "\n".join(f"- {stops.stop_name(stop_id)}: {count}" for stop_id, count in pickups.most_common()) + "\n\n"
+
             message += f"Total number of requests: {total_requests}"
             
             # Send message to group chat
-            await context.bot.send_message(DRIVERS_GROUP_CHAT_ID, message)
+            await context.bot.send_message(tenant.drivers_chat_id, message)
 
             # Update the previous message
-            previous_message = message
+            tenant.previous_message = message
         else:
             message = "No ride requests available."
-            await context.bot.send_message(DRIVERS_GROUP_CHAT_ID, message)
+            await context.bot.send_message(tenant.drivers_chat_id, message)
             print("No pending ride requests.")
         
         # Update the previous pending requests state
-        previous_pending_requests = current_pending_requests
+        tenant.previous_pending_requests = current_pending_requests
     else:
         # Only send "No new ride requests" if there are actually no pending requests
         if not current_pending_requests:
             message = "No ride requests available."
-            await context.bot.send_message(DRIVERS_GROUP_CHAT_ID, message)
+            await context.bot.send_message(tenant.drivers_chat_id, message)
             print("No pending ride requests.")
         else:
             # Send the previous message along with the "No new ride requests" note
-            if previous_message:
-                message = previous_message + "\n\nNo new ride requests."
+            if tenant.previous_message:
+                message = tenant.previous_message + "\n\nNo new ride requests."
             else:
                 message = "No new ride requests."
 
-            await context.bot.send_message(DRIVERS_GROUP_CHAT_ID, message)
+            await context.bot.send_message(tenant.drivers_chat_id, message)
             print("No change in pending ride requests.")
 
+# The buttons carry the id of the user who was asked, only they may answer
+def confirm_keyboard(action, ride_id, requester_id):
+    keyboard = [
+        [
+            InlineKeyboardButton("Yes", callback_data=f'{action}_ride_confirm_{ride_id}_{requester_id}'),
+            InlineKeyboardButton("No", callback_data=f'{action}_ride_cancel_{ride_id}_{requester_id}')
+        ]
+    ]
+    return InlineKeyboardMarkup(keyboard)
+
+# Returns the ride id of a confirm button, or None when someone other than the requester tapped it
+async def confirm_choice(query):
+    parts = query.data.split('_')
+    if len(parts) != 5 or query.from_user.id != int(parts[4]):
+        await query.answer('This choice has expired or belongs to someone else.')
+        return None
+    await query.answer()
+    return int(parts[3])
+
+# Explain why a ride transition matched no row. Only runs on the failure path,
+# the transition itself is a single conditional UPDATE.
+def transition_failed_message(ride_id, action):
+    ride = rm.get_ride_status(ride_id)
+    if ride is None:
+        return f'No such ride ID {ride_id} exists.'
+    if ride[6] == 'completed':
+        if action == 'cancel':
+            return f'Ride request {ride_id} has been completed already hence it cannot be canceled.'
+        return f'Ride request {ride_id} has already been marked as completed.'
+    if ride[6] == 'cancelled':
+        return f'Ride request {ride_id} has already been canceled.'
+    return f'No such ride ID {ride_id} exists or it does not belong to you.'
+
+@tenant_scope
 @workday_check
 async def complete_ride_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not is_allowed_group(update):
@@ -461,64 +740,52 @@ async def complete_ride_command(update: Update, context: ContextTypes.DEFAULT_TY
     if context.args:
         try:
             ride_id = int(context.args[0])  # Assuming RideID is an integer
-            logger.info(f'User {user_id} is attempting to complete ride ID: {ride_id}')
+        except ValueError:
+            await update.message.reply_text('Usage: /complete [RideID] or /complete')
+            return
 
-            # Retrieve ride data
-            ride = rm.get_ride_status(ride_id)
-            
-            if ride is None:
-                await update.message.reply_text(f'No such ride ID {ride_id} exists.')
+        logger.info(f'User {user_id} is attempting to complete ride ID: {ride_id}')
 
-            else:
-                try:
-                    if int(ride[1]) == user_id:
-                        if ride[6] == 'completed':
-                            await update.message.reply_text(f'Ride request {ride_id} has already been marked as completed.')
-                        else:
-                            rm.mark_ride_completed(ride_id)
-                            await update.message.reply_text(f'Ride request {ride_id} has been marked as completed.')
-                    else:
-                        await update.message.reply_text(f'No such ride ID {ride_id} exists or it does not belong to you.')
-                except ValueError:
-                    # Handle case where ride[1] is not an integer (i.e., booked on behalf of someone else)
-                    keyboard = [
-                        [
-                            InlineKeyboardButton("Yes", callback_data=f'complete_ride_confirm_{ride_id}'),
-                            InlineKeyboardButton("No", callback_data=f'complete_ride_cancel_{ride_id}')
-                        ]
-                    ]
-                    reply_markup = InlineKeyboardMarkup(keyboard)
-                    await update.message.reply_text(f'This ride was booked on behalf of {ride[1]}. Do you want to complete it?', reply_markup=reply_markup)
-        except (IndexError, ValueError):
-            await update.message.reply_text('Usage: /complete [RideID] or /complete')
+        if rm.mark_ride_completed(ride_id, owner_id=user_id):
+            await update.message.reply_text(f'Ride request {ride_id} has been marked as completed.')
+            return
+
+        ride = rm.get_ride_status(ride_id)
+        if ride and ride[6] == 'pending' and rm.is_booked_on_behalf(ride) and ride[7] == str(user_id):
+            # Ride was booked on behalf of someone else, ask before completing it
+            reply_markup = confirm_keyboard('complete', ride_id, user_id)
+            await update.message.reply_text(f'This ride was booked on behalf of {ride[1]}. Do you want to complete it?', reply_markup=reply_markup)
+        else:
+            await update.message.reply_text(transition_failed_message(ride_id, 'complete'))
     else:
-        pending_rides = rm.get_user_pending_rides(user_id)
-        
-        if pending_rides:
-            most_recent_ride = pending_rides[0]  # Get the most recent pending ride
-            ride_id = most_recent_ride[0]
-            rm.mark_ride_completed(ride_id)
-            await update.message.reply_text(f'Your most recent ride request (ID: {ride_id}) has been marked as completed.')
+        ride = rm.complete_latest_ride(user_id)
+
+        if ride:
+            await update.message.reply_text(f'Your most recent ride request (ID: {ride[0]}) has been marked as completed.')
         else:
             await update.message.reply_text('You have no pending ride requests to complete.')
 
+@tenant_scope
 @workday_check
 async def complete_ride_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
-    ride_id = int(query.data.split('_')[-1])
+    ride_id = await confirm_choice(query)
+    if ride_id is None:
+        return
 
-    ride = rm.get_ride_status(ride_id)
-    if ride[6] != 'completed':
-        rm.mark_ride_completed(ride_id)
+    if rm.mark_ride_completed(ride_id, booked_by=query.from_user.id):
         await query.edit_message_text(f'Ride request {ride_id} has been marked as completed.')
     else:
-        await query.edit_message_text(f'Ride request {ride_id} is already completed.')
+        await query.edit_message_text(transition_failed_message(ride_id, 'complete'))
 
 @workday_check
 async def complete_ride_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
+    if await confirm_choice(query) is None:
+        return
     await query.edit_message_text('Action canceled.')
 
+@tenant_scope
 @workday_check
 async def cancel_ride_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not is_allowed_group(update):
@@ -530,65 +797,58 @@ async def cancel_ride_command(update: Update, context: ContextTypes.DEFAULT_TYPE
     if context.args:
         try:
             ride_id = int(context.args[0])
-            logger.info(f'User {user_id} is attempting to cancel ride ID: {ride_id}')
-
-            # Check if the ride exists and get its details
-            ride = rm.get_ride_status(ride_id)
-            if ride:
-                logger.info(f'Ride found: {ride}')
-                try:
-                    if int(ride[1]) == user_id:  # Check if the ride belongs to the user
-                        if ride[6] == 'completed':  # Check if the ride is already completed
-                            await update.message.reply_text(f'Ride request {ride_id} has been completed already hence it cannot be canceled.')
-                        else:
-                            rm.cancel_ride(ride_id)
-                            await update.message.reply_text(f'Ride request (ID: {ride_id}) has been canceled.')
-                    else:
-                        await update.message.reply_text(f'No such ride ID {ride_id} exists or it does not belong to you.')
-                except ValueError:
-                        # Check if the ride was booked for someone else
-                        keyboard = [
-                            [
-                                InlineKeyboardButton("Yes", callback_data=f'cancel_ride_confirm_{ride_id}'),
-                                InlineKeyboardButton("No", callback_data=f'cancel_ride_cancel_{ride_id}')
-                            ]
-                        ]
-                        reply_markup = InlineKeyboardMarkup(keyboard)
-                        await update.message.reply_text(f'This ride was booked on behalf of {ride[1]}. Do you want to cancel it?', reply_markup=reply_markup)
-            else:
-                await update.message.reply_text(f'No such ride ID {ride_id} exists.')
         except ValueError:
             await update.message.reply_text('Invalid Ride ID. Please provide a valid ride ID to cancel.')
+            return
+
+        logger.info(f'User {user_id} is attempting to cancel ride ID: {ride_id}')
+
+        if rm.cancel_ride(ride_id, owner_id=user_id):
+            await update.message.reply_text(f'Ride request (ID: {ride_id}) has been canceled.')
+            return
+
+        ride = rm.get_ride_status(ride_id)
+        if ride and ride[6] == 'pending' and rm.is_booked_on_behalf(ride) and ride[7] == str(user_id):
+            # Ride was booked on behalf of someone else, ask before canceling it
+            reply_markup = confirm_keyboard('cancel', ride_id, user_id)
+            await update.message.reply_text(f'This ride was booked on behalf of {ride[1]}. Do you want to cancel it?', reply_markup=reply_markup)
+        else:
+            await update.message.reply_text(transition_failed_message(ride_id, 'cancel'))
     else:
-        pending_rides = rm.get_user_pending_rides(user_id)
-        
-        if pending_rides:
-            most_recent_ride = pending_rides[0]  # Get the most recent pending ride
-            ride_id = most_recent_ride[0]
-            rm.cancel_ride(ride_id)
-            await update.message.reply_text(f'Your most recent ride request (ID: {ride_id}) has been canceled.')
+        ride = rm.cancel_latest_ride(user_id)
+
+        if ride:
+            await update.message.reply_text(f'Your most recent ride request (ID: {ride[0]}) has been canceled.')
         else:
             await update.message.reply_text('You have no pending ride requests to cancel.')
 
+@tenant_scope
 @workday_check
 async def cancel_ride_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
-    ride_id = int(query.data.split('_')[-1])
+    ride_id = await confirm_choice(query)
+    if ride_id is None:
+        return
 
-    ride = rm.get_ride_status(ride_id)
-    if ride and ride[6] == 'completed':
-        await query.edit_message_text(f'Ride request {ride_id} has been completed already hence it cannot be canceled.')
+    if rm.cancel_ride(ride_id, booked_by=query.from_user.id):
+        await query.edit_message_text(f'Ride request (ID: {ride_id}) has been canceled.')
     else:
-        rm.cancel_ride(ride_id)
-        await update.message.reply_text(f'Ride request (ID: {ride_id}) has been canceled.')
+        await query.edit_message_text(transition_failed_message(ride_id, 'cancel'))
 
 @workday_check
 async def cancel_ride_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
+    if await confirm_choice(query) is None:
+        return
     await query.edit_message_text('Action canceled.')
 
+@tenant_scope
 @workday_check
 async def bookings(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not is_allowed_group(update):
+        await update.message.reply_text('This bot is restricted to specific groups.')
+        return
+
     user_id = update.effective_user.id
 
     # Fetch the user's rides from the database
@@ -601,8 +861,8 @@ async def bookings(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if pending_rides:
         message += "📅 Pending Rides:\n"
         for idx, ride in enumerate(pending_rides, 1):
-            location = ride[2]  # Location is the third column
-            destination = ride[3]  # Destination is the fourth column
+            location = stops.stop_name(ride[2])  # Location is the third column
+            destination = stops.stop_name(ride[3])  # Destination is the fourth column
             ride_id = ride[0]  # Ride_id is the first column
             time = datetime.strptime(ride[4], '%H:%M').strftime("%H:%M")  # Time is the fifth column
             purpose = ride[5]
@@ -613,8 +873,8 @@ async def bookings(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if completed_rides:
         message += "\n✅ Completed Rides:\n"
         for idx, ride in enumerate(completed_rides, 1):
-            location = ride[2]  # Location is the third column
-            destination = ride[3]  # Destination is the fourth column
+            location = stops.stop_name(ride[2])  # Location is the third column
+            destination = stops.stop_name(ride[3])  # Destination is the fourth column
             ride_id = ride[0]  # Ride_id is the first column
             time = datetime.strptime(ride[4], '%H:%M').strftime("%H:%M")  # Time is the fifth column
             purpose = ride[5]
@@ -630,10 +890,29 @@ def has_pending_rides() -> bool:
     pending_requests = rm.get_pending_ride_requests()
     return len(pending_requests) > 0
 
+# Direct message every rider of the slot's departure, in the background so
+# the driver's command returns at once. Progress is reported in the driver's chat.
+def notify_slot_riders(update: Update, context: CallbackContext, slot, title, message_for_ride) -> int:
+    if slot == 'unscheduled':
+        return 0
+
+    rides = [ride for ride in rm.get_slot_pending_rides(slot) if not rm.is_booked_on_behalf(ride)]
+    if rides:
+        messages = [(ride[1], message_for_ride(ride)) for ride in rides]
+        context.application.create_task(fanout.fan_out(tenants.current(), f"{title} for {slot}", messages, update.effective_chat.id))
+    return len(rides)
+
+def noted_message(ride):
+    return f"✅ Your ride from {stops.stop_name(ride[2])} to {stops.stop_name(ride[3])} at {ride[4]} has been noted by the drivers. (ID: {ride[0]})"
+
+def en_route_message(ride):
+    return f"🚌 The bus is en route for your {ride[4]} pickup at {stops.stop_name(ride[2])}. (ID: {ride[0]})"
+
 # Handler for note_requests command
+@tenant_scope
 @workday_check
 async def note_requests(update: Update, context: CallbackContext) -> None:
-    if update.effective_chat.id != DRIVERS_GROUP_CHAT_ID:
+    if not is_drivers_chat(update):
         await update.message.reply_text("This command can only be used by drivers.")
         return
     
@@ -642,13 +921,16 @@ async def note_requests(update: Update, context: CallbackContext) -> None:
         return
     
     # Notify the students group
-    await context.bot.send_message(STUDENTS_GROUP_CHAT_ID, "All ride requests have been noted.")
-    await update.message.reply_text("Notified the students group that all ride requests have been noted.")
+    await context.bot.send_message(tenants.current().students_chat_id, "All ride requests have been noted.")
+    slot = rm.current_slot()
+    riders = notify_slot_riders(update, context, slot, "Noted", noted_message)
+    await update.message.reply_text(f"Notified the students group that all ride requests have been noted, and messaging {riders} riders of the {slot} departure.")
 
 # Handler for en_route command
+@tenant_scope
 @workday_check
 async def en_route(update: Update, context: CallbackContext) -> None:
-    if update.effective_chat.id != DRIVERS_GROUP_CHAT_ID:
+    if not is_drivers_chat(update):
         await update.message.reply_text("This command can only be used by drivers.")
         return
     
@@ -656,9 +938,66 @@ async def en_route(update: Update, context: CallbackContext) -> None:
         await update.message.reply_text("No pending ride requests to notify.")
         return
     
+    # Live arrival times follow this departure until its grace window is over
+    slot = rm.current_slot()
+    if slot != 'unscheduled':
+        tenants.current().en_route_slot = (clock.now().date(), slot)
+
     # Notify the students group
-    await context.bot.send_message(STUDENTS_GROUP_CHAT_ID, "The bus is now en route.")
-    await update.message.reply_text("Notified the students group that the bus is en route.")
+    await context.bot.send_message(tenants.current().students_chat_id, "The bus is now en route.")
+    riders = notify_slot_riders(update, context, slot, "En route", en_route_message)
+    await update.message.reply_text(f"Notified the students group that the bus is en route, and messaging {riders} riders of the {slot} departure. Share your live location here to pin arrival times for the riders.")
+
+# Drivers share their live location in the drivers chat. Telegram edits that
+# message with every new position, each edit updates the riders' ETAs.
+@tenant_scope
+async def driver_location(update: Update, context: CallbackContext) -> None:
+    if not is_drivers_chat(update):
+        return
+
+    location = update.effective_message.location
+    if location.live_period is None:
+        return  # A one-off location, not a live one
+
+    await live_eta.update_location(location.latitude, location.longitude, context.job_queue)
+
+def format_stats_section(title, rows):
+    section = f"{title}:\n"
+    if not rows:
+        return section + "None\n\n"
+    for key, requested, completed, cancelled in rows:
+        section += f"- {key}: {requested} requested, {completed} completed, {cancelled} canceled\n"
+    return section + "\n"
+
+# Handler for stats command
+@tenant_scope
+@workday_check
+async def stats(update: Update, context: CallbackContext) -> None:
+    if not is_drivers_chat(update):
+        await update.message.reply_text("This command can only be used by drivers.")
+        return
+
+    period = context.args[0].lower() if context.args else 'day'
+    if period not in ['day', 'week']:
+        await update.message.reply_text('Usage: /stats [day|week]')
+        return
+
+    end_date = clock.now().date()
+    start_date = end_date - timedelta(days=6) if period == 'week' else end_date
+
+    totals = rm.get_ride_stats(start_date, end_date)
+    if not totals:
+        await update.message.reply_text(f"No ride data for this {period}.")
+        return
+
+    _, requested, completed, cancelled = totals[0]
+    message = f"📊 Ride stats for {start_date}" + (f" to {end_date}" if start_date != end_date else "") + ":\n\n"
+    message += f"Requested: {requested}\nCompleted: {completed}\nCanceled: {cancelled}\n\n"
+    message += format_stats_section("By departure", rm.get_ride_stats(start_date, end_date, 'slot'))
+    message += format_stats_section("By purpose", rm.get_ride_stats(start_date, end_date, 'purpose'))
+    message += format_stats_section("By route", rm.get_ride_stats(start_date, end_date, 'route')[:10])
+
+    await update.message.reply_text(message.strip())
 
 @workday_check
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -671,10 +1010,12 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         "/start - Start the bot and see the welcome message.\n"
         "/ride [Location] [Destination] [Time] [Purpose] - Request a shuttle ride. Example: /ride Library Dormitory 14:00 class\n"
         "/ride_for [Name] [Location] [Destination] [Time] [Purpose] - Request a shuttle ride on behalf of a colleague. Example: /ride_for Anthony CCB MCF 14:00 class\n"
+        "/ride_recurring [Days] [Location] [Destination] [Time] [Purpose] - Book the same ride every workday. Example: /ride_recurring weekdays Library Dormitory 07:15 class\n"
         "/cancel [RideID] (optional) - Cancel your most recent ride or a specific ride by ID. Example: /cancel or /cancel 123\n"
         "/complete [RideID] (optional) - Manually mark a ride as completed. Example: /complete or /complete 123\n"
         "/noted - For drivers use only.\n"
         "/en_route - For drivers use only.\n"
+        "/stats [day|week] - Ride statistics, for drivers use only.\n"
         "/help - Show this help message.\n"
         "Note: The purpose can be one of the following: class, switch, closed, other.\n"
     )
@@ -682,16 +1023,25 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
 
 async def error_handler(update: Update, context: CallbackContext) -> None:
     logger.error(f"Error: {context.error} occurred with update {update}")
-    if update:
-        await update.message.reply_text('An error occurred. Please try again later.')
+    # Edited messages such as live location updates have no update.message,
+    # and some updates have no message at all to reply to
+    if isinstance(update, Update) and update.effective_message is not None:
+        await update.effective_message.reply_text('An error occurred. Please try again later.')
 
-def main() -> None:
-    # Create the Application and pass it your bot's token.
-    application = Application.builder().token(bot_token).build()
+def build_application() -> Application:
+    # Create the Application around the shared bot, so handlers and scheduled jobs use one connection pool
+    application = Application.builder().bot(bot_client.bot).build()
+
+    # Record incoming updates before any handler runs, if enabled
+    if update_recorder.enabled():
+        application.add_handler(TypeHandler(Update, update_recorder.record_update), group=-1)
 
     # Register command handlers
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("ride", ride))
+    application.add_handler(CommandHandler("ride_for", ride_for))
+    application.add_handler(CallbackQueryHandler(ride_stop_choice, pattern='^ride_stop_'))
+    application.add_handler(CommandHandler("ride_recurring", ride_recurring))
     application.add_handler(CommandHandler("cancel", cancel_ride_command))
     application.add_handler(CallbackQueryHandler(cancel_ride_confirm, pattern='^cancel_ride_confirm_'))
     application.add_handler(CallbackQueryHandler(cancel_ride_cancel, pattern='^cancel_ride_cancel_'))
@@ -701,15 +1051,28 @@ def main() -> None:
     application.add_handler(CommandHandler("bookings", bookings))
     application.add_handler(CommandHandler("noted", note_requests))
     application.add_handler(CommandHandler("en_route", en_route))
+    application.add_handler(CommandHandler("stats", stats))
+    application.add_handler(MessageHandler(filters.LOCATION, driver_location))
     application.add_handler(CommandHandler("help", help_command))
 
     # Schedule job to notify drivers periodically
     application.job_queue.run_repeating(notify_drivers, interval=900, first=0)  # Every 15 mins
-    # application.job_queue.run_repeating(lambda context: rm.auto_complete_rides(), interval=300, first=0)  # Every 5 mins
-    application.job_queue.run_repeating(rm.auto_complete_rides_wrapper, interval=300, first=0)
+    # Auto-complete rides at their deadline, the job only wakes up when a ride is due
+    rm.start_auto_complete(application.job_queue)
     # Error handler registration
     application.add_error_handler(error_handler)
 
+    return application
+
+def main() -> None:
+    application = build_application()
+
+    # Start the database reset scheduler as a separate process using the virtual environment's Python interpreter
+    subprocess.Popen([python_executable, "reset_database.py"])
+
+    # Start the scheduler
+    scheduler.start()
+
     # Start the coroutine for managing notifications
     loop = asyncio.get_event_loop()
     loop.create_task(start_tasks())
@@ -723,8 +1086,8 @@ def main() -> None:
     application.run_webhook(
         listen="0.0.0.0",
         port=int(PORT),
-        url_path=bot_token,
-        webhook_url=f'https://your_heroku_app_name.herokuapp.com/{bot_token}'
+        url_path=bot_client.bot_token,
+        webhook_url=f'https://your_heroku_app_name.herokuapp.com/{bot_client.bot_token}'
     )
 
 if __name__ == '__main__':
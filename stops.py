@@ -0,0 +1,74 @@
+import difflib
+import json
+import os
+import unicodedata
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Canonical stop registry. Stops are defined in STOPS_FILE with a fixed
+# integer id, a display name, aliases and coordinates, and rides store the id.
+STOPS_FILE = os.getenv('STOPS_FILE', 'stops.json')
+
+# Number of stops offered when the input is ambiguous
+MAX_SUGGESTIONS = 4
+# Similarity a single fuzzy match needs to be accepted without asking
+FUZZY_ACCEPT_RATIO = 0.85
+
+stops_by_id = {}
+aliases = {}       # normalized name or alias -> stop id
+prefix_index = {}  # every prefix of a normalized alias -> set of stop ids
+
+def normalize(text):
+    # Case, accents, spaces and punctuation don't matter: "Main-Library" == "mainlibrary"
+    text = unicodedata.normalize('NFKD', text).encode('ascii', 'ignore').decode()
+    return ''.join(ch for ch in text.lower() if ch.isalnum())
+
+def load_stops(path=STOPS_FILE):
+    stops_by_id.clear()
+    aliases.clear()
+    prefix_index.clear()
+
+    with open(path, encoding='utf-8') as stops_file:
+        for stop in json.load(stops_file):
+            stops_by_id[stop['id']] = stop
+            for alias in [stop['name']] + stop.get('aliases', []):
+                key = normalize(alias)
+                aliases[key] = stop['id']
+                for end in range(1, len(key) + 1):
+                    prefix_index.setdefault(key[:end], set()).add(stop['id'])
+
+    logger.info(f'Loaded {len(stops_by_id)} stops from {path}')
+
+def stop_name(stop_id):
+    stop = stops_by_id.get(stop_id)
+    return stop['name'] if stop else f'Stop {stop_id}'
+
+def stop_names():
+    return [stop['name'] for stop in stops_by_id.values()]
+
+def resolve(text):
+    # Returns (stop_id, []) for a confident match, otherwise (None, suggested stop ids)
+    key = normalize(text)
+    if not key:
+        return None, []
+
+    # Exact name or alias
+    if key in aliases:
+        return aliases[key], []
+
+    # Unambiguous prefix, e.g. "libr"
+    candidates = prefix_index.get(key)
+    if candidates:
+        if len(candidates) == 1 and len(key) > 1:
+            return next(iter(candidates)), []
+        return None, sorted(candidates, key=stop_name)[:MAX_SUGGESTIONS]
+
+    # Typos, e.g. "Dormitry"
+    matches = difflib.get_close_matches(key, aliases.keys(), n=MAX_SUGGESTIONS * 2, cutoff=0.6)
+    suggestions = list(dict.fromkeys(aliases[match] for match in matches))
+    if len(suggestions) == 1 and difflib.SequenceMatcher(None, key, matches[0]).ratio() >= FUZZY_ACCEPT_RATIO:
+        return suggestions[0], []
+    return None, suggestions[:MAX_SUGGESTIONS]
+
+load_stops()
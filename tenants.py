@@ -0,0 +1,95 @@
+import contextvars
+import json
+import logging
+import os
+from contextlib import contextmanager
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+# Shuttle services run by this deployment. Each tenant is defined in
+# TENANTS_FILE with its group chats, drivers chat, timetable, seat capacity per
+# departure and its own SQLite database, stored under RIDES_DB_DIR. The
+# repository ships tenants.example.json to copy from.
+TENANTS_FILE = os.getenv('TENANTS_FILE', 'tenants.json')
+DATABASE_DIR = os.getenv('RIDES_DB_DIR', '.')
+
+DEFAULT_DEPARTURE_TIMES = ['07:15', '09:15', '11:15', '13:15', '15:15', '17:15', '19:15']
+
+class Tenant:
+    def __init__(self, config):
+        self.id = config['id']
+        self.name = config.get('name', self.id)
+        self.group_chat_ids = {self.chat_id('group_chat_ids', chat_id) for chat_id in config['group_chat_ids']}
+        self.drivers_chat_id = self.chat_id('drivers_chat_id', config['drivers_chat_id'])
+        self.students_chat_id = self.chat_id('students_chat_id', config['students_chat_id'])
+        self.departure_times = sorted(
+            datetime.strptime(departure_time, '%H:%M').strftime('%H:%M')
+            for departure_time in config.get('departure_times', DEFAULT_DEPARTURE_TIMES)
+        )
+        self.capacity = config.get('capacity')  # Seats per departure, None for no limit
+        self.database = os.path.join(DATABASE_DIR, config.get('database', f'rides_{self.id}.db'))
+
+        # Runtime state, set up by ride_manager and shuttle_bot
+        self.conn = None
+        self.c = None
+        self.auto_complete_heap = []
+        self.auto_complete_job = None
+        self.previous_pending_requests = set()
+        self.previous_message = ""
+        self.live_status = None  # Pinned ETA message of the current slot, see live_eta
+        self.en_route_slot = None  # (date, departure) the drivers set off for with /en_route
+        self.snapshot = None  # Metrics of the snapshot being taken, see backup
+
+    def chat_id(self, field, value):
+        # Telegram chat ids are integers, group ids are negative
+        if isinstance(value, bool) or not str(value).lstrip('-').isdigit():
+            raise ValueError(
+                f'Tenant {self.id}: {field} must be a Telegram chat id such as '
+                f'-1001234567890, got {value!r}. Replace the placeholders copied from tenants.example.json.'
+            )
+        return int(value)
+
+    def chat_ids(self):
+        return self.group_chat_ids | {self.drivers_chat_id, self.students_chat_id}
+
+tenants = []
+tenants_by_chat = {}  # chat id -> Tenant, for O(1) lookups on every update
+
+def load_tenants(path=TENANTS_FILE):
+    tenants.clear()
+    tenants_by_chat.clear()
+
+    if not os.path.exists(path):
+        raise FileNotFoundError(f'{path} not found. Copy tenants.example.json to {path} and fill in your chat ids, or set TENANTS_FILE.')
+
+    with open(path, encoding='utf-8') as tenants_file:
+        for config in json.load(tenants_file):
+            tenant = Tenant(config)
+            for chat_id in tenant.chat_ids():
+                owner = tenants_by_chat.setdefault(chat_id, tenant)
+                if owner is not tenant:
+                    raise ValueError(f'Chat {chat_id} is configured for both {owner.id} and {tenant.id}')
+            tenants.append(tenant)
+
+    logger.info(f'Loaded tenants: {[tenant.id for tenant in tenants]}')
+
+def tenant_for_chat(chat_id):
+    return tenants_by_chat.get(int(chat_id))
+
+# The tenant the running handler or job works on. ride_manager reads its
+# database and timetable from here.
+current_tenant = contextvars.ContextVar('current_tenant', default=None)
+
+def current():
+    return current_tenant.get()
+
+@contextmanager
+def use(tenant):
+    token = current_tenant.set(tenant)
+    try:
+        yield tenant
+    finally:
+        current_tenant.reset(token)
+
+load_tenants()
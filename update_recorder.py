@@ -0,0 +1,35 @@
+import json
+import logging
+import os
+from datetime import timezone
+from logging.handlers import TimedRotatingFileHandler
+from telegram import Update
+from telegram.ext import CallbackContext
+import clock
+
+# Opt-in capture of incoming updates for replay.py. Set UPDATE_LOG to a file
+# path to enable it; the log rotates at midnight and keeps UPDATE_LOG_BACKUPS days.
+UPDATE_LOG = os.getenv('UPDATE_LOG')
+UPDATE_LOG_BACKUPS = int(os.getenv('UPDATE_LOG_BACKUPS', 7))
+
+recorder = logging.getLogger('update_recorder')
+recorder.propagate = False
+
+def enabled():
+    return bool(UPDATE_LOG)
+
+def start_recording(path, backups=UPDATE_LOG_BACKUPS):
+    handler = TimedRotatingFileHandler(path, when='midnight', backupCount=backups, encoding='utf-8')
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    recorder.addHandler(handler)
+    recorder.setLevel(logging.INFO)
+
+# One JSON line per update: its arrival time and the raw update
+async def record_update(update: Update, context: CallbackContext) -> None:
+    if not recorder.handlers:
+        start_recording(UPDATE_LOG)
+    entry = {
+        'received_at': clock.now(timezone.utc).isoformat(),
+        'update': update.to_dict(),
+    }
+    recorder.info(json.dumps(entry, ensure_ascii=False))